@@ -0,0 +1,113 @@
+'''
+Stand-in for the earthengine-api package, for offline benchmarks.
+
+Every attribute access & call builds a node of a computation graph,
+as the real client library does, without any request. Only getInfo
+and getMapId are round trips: they sleep for a configurable latency
+and fail with HTTP 429 at a configurable rate. Configured with:
+
+    FAKE_EE_LATENCY     seconds per round trip, e.g. getInfo=0.3,getMapId=0.5
+    FAKE_EE_JITTER      relative jitter of the latency (default 0.25)
+    FAKE_EE_ERROR_RATE  probability of a 429 error per round trip (default 0)
+'''
+import os
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+
+
+LATENCY = {'getInfo': 0.3, 'getMapId': 0.5}
+LATENCY.update(
+    (call_type, float(seconds))
+    for call_type, seconds in (
+        item.split('=') for item in os.environ.get('FAKE_EE_LATENCY', '').split(',') if item
+    )
+)
+JITTER = float(os.environ.get('FAKE_EE_JITTER', 0.25))
+ERROR_RATE = float(os.environ.get('FAKE_EE_ERROR_RATE', 0))
+
+_lock = threading.Lock()
+_counts = Counter()
+
+
+class EEException(Exception):
+    pass
+
+
+def _count(name, n=1):
+    with _lock:
+        _counts[name] += n
+
+
+def stats():
+    '''Return the graph nodes built & the round trips made (and failed) by type'''
+    with _lock:
+        return dict(_counts)
+
+
+def reset_stats():
+    with _lock:
+        _counts.clear()
+
+
+def _round_trip(call_type):
+    _count(call_type)
+    time.sleep(max(0, LATENCY.get(call_type, 0) * random.uniform(1 - JITTER, 1 + JITTER)))
+    if random.random() < ERROR_RATE:
+        _count('{}_429'.format(call_type))
+        raise EEException('Too many requests (429): fake rate limit')
+
+
+class _Values(dict):
+    '''getInfo result: any band statistic or property is available'''
+    def __missing__(self, key):
+        return 0.5
+
+
+class _Node:
+    '''A node of the computation graph'''
+    def __init__(self, path):
+        self._path = path
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return _Node('{}.{}'.format(self._path, name))
+
+    def __call__(self, *args, **kwargs):
+        _count('nodes')
+        method = self._path.rsplit('.', 1)[-1]
+
+        if method == 'getInfo':
+            _round_trip('getInfo')
+            return _Values()
+        if method == 'getMapId':
+            _round_trip('getMapId')
+            return {'mapid': 'projects/fake-ee/maps/{}'.format(uuid.uuid4().hex), 'token': ''}
+        if method == 'serialize':
+            return self._path
+        if method in ('map', 'iterate'):
+            # Build the graph of the mapped function, as the client library does
+            for arg in args:
+                if callable(arg) and not isinstance(arg, _Node):
+                    arg(_Node('{}.element'.format(self._path)))
+
+        return _Node('{}()'.format(self._path))
+
+
+def __getattr__(name):
+    return _Node('ee.{}'.format(name))
+
+
+def Initialize(*args, **kwargs):
+    _round_trip('initialize')
+
+
+def Reset():
+    pass
+
+
+def ServiceAccountCredentials(*args, **kwargs):
+    return None
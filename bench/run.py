@@ -0,0 +1,253 @@
+'''
+Offline benchmark of the Django views, against the fake `ee`
+package of bench/fake_ee (no credentials, no network):
+
+    python bench/run.py --scenarios asyncEE --requests 200 --concurrency 16 \
+        --latency getInfo=0.3,getMapId=0.5 --out bench/results/asyncEE.json
+
+Every worker process runs a share of the requests with its own pool
+of client threads (or coroutines with --async), and reports its
+latencies, EE round trips & peak memory. Requests cycle over --aois
+distinct AOIs: 1 measures warm caches, as many as the requests
+measures cold ones.
+'''
+import argparse
+import asyncio
+import copy
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+import types
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = {
+    'map': {'method': 'get', 'path': '/map/'},
+    'asyncEE': {'method': 'post', 'path': '/ee/', 'layers': 'composites'},
+    'water_quality_asyncEE': {'method': 'post', 'path': '/water_quality_ee/', 'layers': 'ndci'},
+}
+
+
+def setup(options):
+    '''Set up Django in a worker, against the fake ee package'''
+    sys.path[:0] = [os.path.join(ROOT, 'bench', 'fake_ee'), ROOT]
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'bench.settings'
+    os.environ['GEE_ASYNC_VIEWS'] = '1' if options['async'] else ''
+
+    # EE credentials are not needed by the fake ee package
+    try:
+        import gee.app_secrets  # noqa: F401
+    except ImportError:
+        sys.modules['gee.app_secrets'] = types.SimpleNamespace(credentials=None)
+
+    import django
+    django.setup()
+
+
+def aois(count):
+    '''Distinct AOIs: the default AOI, shifted by ~100m steps'''
+    with open(os.path.join(ROOT, 'default_geojson.json'), encoding='utf-8') as f:
+        feature = json.load(f)
+
+    def shift(coordinates, offset):
+        if isinstance(coordinates[0], (int, float)):
+            return [coordinates[0] + offset, coordinates[1]] + list(coordinates[2:])
+        return [shift(c, offset) for c in coordinates]
+
+    result = []
+    for i in range(count):
+        aoi = copy.deepcopy(feature)
+        aoi['geometry']['coordinates'] = shift(feature['geometry']['coordinates'], i * 0.001)
+        result.append(aoi)
+    return result
+
+
+def request_kwargs(scenario, aoi, options):
+    if scenario['method'] == 'get':
+        return {}
+    layers = options['layers'] or scenario['layers']
+    return {
+        'data': json.dumps({'aoi': aoi, 'year': options['year'], 'layers': layers}),
+        'content_type': 'application/json',
+    }
+
+
+def worker(options, scenario_name, index, requests, queue):
+    try:
+        queue.put(run_worker(options, scenario_name, index, requests))
+    except BaseException:
+        queue.put({'worker': index, 'error': traceback.format_exc()})
+        raise
+
+
+def run_worker(options, scenario_name, index, requests):
+    setup(options)
+    import ee
+    from django.test import AsyncClient, Client
+
+    scenario = SCENARIOS[scenario_name]
+    areas = aois(options['aois'])
+    requests = range(index, requests * options['workers'], options['workers'])
+    latencies, errors = [], 0
+
+    def check(response, start):
+        nonlocal errors
+        latencies.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            errors += 1
+
+    def run(i, client):
+        start = time.perf_counter()
+        check(getattr(client, scenario['method'])(
+            scenario['path'], **request_kwargs(scenario, areas[i % len(areas)], options)), start)
+
+    async def run_async(i, client, semaphore):
+        async with semaphore:
+            start = time.perf_counter()
+            check(await getattr(client, scenario['method'])(
+                scenario['path'], **request_kwargs(scenario, areas[i % len(areas)], options)), start)
+
+    # Requests failing after the EE retries (e.g. with a high --error-rate)
+    # are counted as errors, instead of raising in the worker
+    ee.reset_stats()
+    start = time.perf_counter()
+    if options['async']:
+        async def run_all():
+            client = AsyncClient(raise_request_exception=False)
+            semaphore = asyncio.Semaphore(options['concurrency'])
+            await asyncio.gather(*(run_async(i, client, semaphore) for i in requests))
+        asyncio.run(run_all())
+    else:
+        client = Client(raise_request_exception=False)
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+            list(pool.map(lambda i: run(i, client), requests))
+    elapsed = time.perf_counter() - start
+
+    return {
+        'worker': index,
+        'elapsed': elapsed,
+        'latencies': latencies,
+        'errors': errors,
+        'ee': ee.stats(),
+        # kB on Linux
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def run_scenario(options, scenario_name):
+    '''Run a scenario on fresh caches, and summarize it'''
+    os.environ['BENCH_DIR'] = tempfile.mkdtemp(prefix='gee-bench-')
+    subprocess.check_call([sys.executable, os.path.join(ROOT, 'manage.py'), 'migrate', '-v', '0',
+                           '--settings', 'bench.settings'], cwd=ROOT,
+                          env=dict(os.environ, PYTHONPATH=os.path.join(ROOT, 'bench', 'fake_ee')))
+
+    per_worker = -(-options['requests'] // options['workers'])
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    processes = [
+        context.Process(target=worker, args=(options, scenario_name, i, per_worker, queue))
+        for i in range(options['workers'])
+    ]
+    for process in processes:
+        process.start()
+    reports = [queue.get() for _ in processes]
+    for process in processes:
+        process.join()
+    for report in reports:
+        if 'error' in report:
+            sys.exit('Worker {} failed:\n{}'.format(report['worker'], report['error']))
+
+    latencies = np.array([latency for report in reports for latency in report['latencies']])
+    requests = len(latencies)
+    elapsed = max(report['elapsed'] for report in reports)
+    ee_calls = {}
+    for report in reports:
+        for name, count in report['ee'].items():
+            ee_calls[name] = ee_calls.get(name, 0) + count
+    round_trips = sum(count for name, count in ee_calls.items() if name in ('getInfo', 'getMapId'))
+
+    return {
+        'requests': requests,
+        'errors': sum(report['errors'] for report in reports),
+        'elapsed': round(elapsed, 3),
+        'rps': round(requests / elapsed, 2),
+        'latency': {
+            'mean': round(float(latencies.mean()), 4),
+            'p50': round(float(np.percentile(latencies, 50)), 4),
+            'p95': round(float(np.percentile(latencies, 95)), 4),
+            'p99': round(float(np.percentile(latencies, 99)), 4),
+            'max': round(float(latencies.max()), 4),
+        },
+        'ee_calls': ee_calls,
+        'ee_calls_per_request': round(round_trips / requests, 3),
+        'graph_nodes_per_request': round(ee_calls.get('nodes', 0) / requests, 1),
+        'max_rss_mb_per_worker': [round(report['max_rss_mb'], 1)
+                                  for report in sorted(reports, key=lambda r: r['worker'])],
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--requests', type=int, default=100, help='Requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=8, help='Concurrent requests per worker')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes')
+    parser.add_argument('--async', action='store_true', help='Use the native async views')
+    parser.add_argument('--aois', type=int, default=1, help='Distinct AOIs the requests cycle over')
+    parser.add_argument('--year', type=int, default=2021)
+    parser.add_argument('--layers', type=json.loads, default=None,
+                        help='Products of the EE requests, as JSON (e.g. \'["composites", "max_ndvi"]\')')
+    parser.add_argument('--latency', default='getInfo=0.3,getMapId=0.5',
+                        help='Simulated seconds per EE round trip, by call type')
+    parser.add_argument('--jitter', type=float, default=0.25, help='Relative jitter of the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Probability of a 429 per round trip')
+    parser.add_argument('--out', help='Save the results as JSON')
+    options = vars(parser.parse_args())
+
+    os.environ['FAKE_EE_LATENCY'] = options['latency']
+    os.environ['FAKE_EE_JITTER'] = str(options['jitter'])
+    os.environ['FAKE_EE_ERROR_RATE'] = str(options['error_rate'])
+
+    results = {
+        'date': datetime.now(timezone.utc).isoformat(),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'options': options,
+        'scenarios': {},
+    }
+    for name in options['scenarios']:
+        result = results['scenarios'][name] = run_scenario(options, name)
+        print('{:<22} {:>8.2f} req/s  p50 {:.3f}s  p95 {:.3f}s  p99 {:.3f}s  '
+              '{:.2f} EE calls/req  {} errors  {} MB/worker'.format(
+                  name, result['rps'], result['latency']['p50'], result['latency']['p95'],
+                  result['latency']['p99'], result['ee_calls_per_request'], result['errors'],
+                  max(result['max_rss_mb_per_worker'])))
+
+    if options['out']:
+        os.makedirs(os.path.dirname(os.path.abspath(options['out'])), exist_ok=True)
+        with open(options['out'], 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
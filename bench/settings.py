@@ -0,0 +1,24 @@
+'''
+Settings of the benchmarks: the project settings, with the caches,
+the database & the rate limiter state in the directory of the run
+(BENCH_DIR)
+'''
+import os
+import tempfile
+
+from djangoGEE.settings import *   # noqa: F401,F403
+from djangoGEE.settings import CACHES, LOGGING
+
+
+BENCH_DIR = os.environ.get('BENCH_DIR') or tempfile.mkdtemp(prefix='gee-bench-')
+
+DEBUG = False
+CACHES['gee'] = dict(CACHES['gee'], LOCATION=os.path.join(BENCH_DIR, 'gee'))
+DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': os.path.join(BENCH_DIR, 'db.sqlite3')}}
+GEE_RATE_LIMIT_FILE = os.path.join(BENCH_DIR, 'ee_rate_limit.json')
+GEE_TILE_CACHE_DIR = os.path.join(BENCH_DIR, 'tiles')
+GEE_SEED_DIR = os.path.join(BENCH_DIR, 'seed')
+GEE_LOCK_DIR = os.path.join(BENCH_DIR, 'locks')
+GEE_RATE_LIMIT = float(os.environ.get('BENCH_RATE_LIMIT', 1000))
+GEE_RATE_LIMIT_BURST = float(os.environ.get('BENCH_RATE_LIMIT_BURST', 1000))
+LOGGING['loggers']['gee']['level'] = os.environ.get('BENCH_LOG_LEVEL', 'WARNING')
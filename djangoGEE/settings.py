@@ -72,6 +72,40 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/4.0/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'gee': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache', 'gee'),
+    },
+}
+
+
+# Logging
+# https://docs.djangoproject.com/en/4.0/topics/logging/
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'gee': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
 
@@ -110,3 +144,97 @@ USE_TZ = True
 STATIC_URL = 'static/'
 STATICFILES_DIRS = (os.path.join(BASE_DIR, 'django_static', 'dirs'),)
 STATIC_ROOT = os.path.join(BASE_DIR, 'django_static', 'root')
+
+
+# Earth Engine
+# Number of (AOI, year, sensor) image collections memoized per process
+GEE_SERVICE_CACHE_SIZE = 64
+
+# Cache alias holding Earth Engine map IDs & statistics. The file based
+# backend is shared by all gunicorn workers; any Django cache backend
+# (locmem, memcached...) can be used instead
+GEE_CACHE = 'gee'
+# Seconds a map ID is reused. Must stay below the lifetime of the map IDs
+# issued by Earth Engine, after which their tiles are no longer served
+GEE_MAPID_TTL = 60 * 60 * 2
+# Seconds image statistics (used for visual parameters) are reused
+GEE_STATS_TTL = 60 * 60 * 24
+# Products of a multi-layer request computed in parallel, per process
+GEE_MAX_PARALLEL_PRODUCTS = 4
+# Serve the EE endpoints with the native async views (ASGI deployments,
+# see gunicorn/asgi.py), and the number of in-flight EE computations
+# they allow per process
+GEE_ASYNC_VIEWS = os.environ.get('GEE_ASYNC_VIEWS', '0') == '1'
+GEE_MAX_ASYNC_REQUESTS = 200
+# Token bucket shared by all the workers of the host, limiting the rate
+# of EE calls (calls per second, and burst size) to avoid HTTP 429 errors
+GEE_RATE_LIMIT_FILE = os.path.join(BASE_DIR, 'cache', 'ee_rate_limit.json')
+GEE_RATE_LIMIT = 10
+GEE_RATE_LIMIT_BURST = 20
+# Retries of EE calls failing with HTTP 429/5xx, with exponential backoff
+GEE_MAX_RETRIES = 5
+GEE_RETRY_BASE_DELAY = 0.5
+GEE_RETRY_MAX_DELAY = 30
+# Tile proxy: Earth Engine tile server, pooled connections to it, and the
+# size-bounded LRU cache of the tiles (on disk, with a memory front)
+GEE_TILE_UPSTREAM = 'https://earthengine.googleapis.com/v1alpha'
+GEE_TILE_POOL_SIZE = 32
+GEE_TILE_TIMEOUT = 30
+GEE_TILE_CACHE_DIR = os.path.join(BASE_DIR, 'cache', 'tiles')
+GEE_TILE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+GEE_TILE_MEMORY_CACHE_BYTES = 32 * 1024 * 1024
+# Seconds browsers may cache a tile. Tiles of a map ID never change
+GEE_TILE_MAX_AGE = 60 * 60 * 24
+# MBTiles pre-rendered by the seed_tiles command, served by the tile proxy
+GEE_SEED_DIR = os.path.join(BASE_DIR, 'cache', 'seed')
+# AOI & year of the map pages when none was posted, and the seconds
+# browsers may cache the default AOI before revalidating it
+GEE_DEFAULT_AOI = os.path.join(BASE_DIR, 'default_geojson.json')
+GEE_DEFAULT_YEAR = 2021
+GEE_DEFAULT_AOI_MAX_AGE = 60 * 60 * 24
+# AOIs are simplified before being sent to Earth Engine, with a tolerance
+# (in meters) of half the 30m Landsat pixel
+GEE_AOI_SIMPLIFY_TOLERANCE = 15
+# Identical concurrent product requests share one computation: seconds
+# a worker waits for another worker's result, polling interval, and how
+# long that result is kept for the waiting workers
+GEE_SINGLE_FLIGHT_TIMEOUT = 120
+GEE_SINGLE_FLIGHT_POLL = 0.2
+GEE_SINGLE_FLIGHT_RESULT_TTL = 60
+# Lock files making the workers of the host compute a product (or queue
+# a job) one at a time: one small file per key, on the local disk
+GEE_LOCK_DIR = os.path.join(BASE_DIR, 'cache', 'locks')
+# Fetch & log debug metadata of the products (cloud cover, number of
+# scenes...): one more EE round trip per product, off in production
+GEE_DIAGNOSTICS = os.environ.get('GEE_DIAGNOSTICS', '0') == '1'
+# Seconds between the heartbeats of the streamed EE responses
+GEE_STREAM_HEARTBEAT = 10
+# Days of the Savitzky-Golay window smoothing the index time series
+GEE_TIMESERIES_WINDOW = 31
+# Zonal statistics: parcels per request, and the size of the chunks of
+# parcels reduced per EE call (features, and vertices of the payload)
+GEE_ZONAL_MAX_FEATURES = 5000
+GEE_ZONAL_CHUNK_FEATURES = 200
+GEE_ZONAL_CHUNK_VERTICES = 50000
+# Persist map IDs & statistics in the database (ProductResult), so that
+# they survive worker restarts. Expired rows are deleted by the
+# prune_results command, e.g. from cron
+GEE_RESULT_STORE = True
+# Background jobs (submit/poll endpoints): threads computing them per
+# process, attempts per job, seconds their state is kept, and seconds
+# without an update after which an unfinished job is considered lost
+GEE_JOB_WORKERS = 2
+GEE_JOB_MAX_ATTEMPTS = 3
+GEE_JOB_TTL = 60 * 60 * 6
+GEE_JOB_STALE_AFTER = 60 * 30
+# Pixel inspection: meters of the grid cells values are sampled &
+# cached per, points per request, and seconds the map pages collect
+# clicks for, to be sampled with a single request & EE call
+GEE_PIXEL_GRID = 30
+GEE_PIXEL_MAX_POINTS = 500
+GEE_PIXEL_COALESCE_WINDOW = 0.15
+# Palette stretch of the index layers: percentiles of the values over
+# the AOI, from a histogram with that many bins, sampled at that scale
+GEE_STRETCH_PERCENTILES = (2, 98)
+GEE_STRETCH_BINS = 256
+GEE_STRETCH_SCALE = 100
@@ -1,16 +1,36 @@
 from re import template
 from django.contrib import admin
+from django.conf import settings
 from django.urls import path
-from gee import views
+from gee import async_views, views
+
+# Native async views only pay off when served over ASGI
+ee_views = async_views if settings.GEE_ASYNC_VIEWS else views
 
 urlpatterns = [
     
     path('', views.index, name="index"),
     path('map/', views.map, name="map"),
-    path('ee/', views.asyncEE, name="asyncEE"),
+    path('aoi/default.geojson', views.default_aoi_geojson, name="default_aoi"),
+    path('ee/', ee_views.asyncEE, name="asyncEE"),
+    path('products/', views.products, name="products"),
+    path('timeseries/', views.timeseries, name="timeseries"),
+    path('zonal/', ee_views.zonal, name="zonal"),
+    path('pixels/', ee_views.pixels, name="pixels"),
+    path('legend/', views.legend, name="legend"),
+    path('jobs/', views.submit_job, name="submit_job"),
+    path('jobs/<str:job_id>/', views.job_status, name="job_status"),
+    path('metrics', views.metrics, name="metrics"),
+    path('tiles/<path:mapid>/<int:z>/<int:x>/<int:y>', ee_views.tile, name="tile"),
 
 
     path('water_quality/', views.water_quality_index, name='water_quality_index'),
     path('water_quality_map/', views.water_quality_map, name="water_quality_map"),
-    path('water_quality_ee/', views.water_quality_asyncEE, name="water_quality_asyncEE")
+    path('water_quality_ee/', ee_views.water_quality_asyncEE, name="water_quality_asyncEE"),
 ]
+
+if views.stream_layers():
+    urlpatterns += [
+        path('ee/stream/', views.asyncEE_stream, name="asyncEE_stream"),
+        path('water_quality_ee/stream/', views.water_quality_asyncEE_stream, name="water_quality_asyncEE_stream"),
+    ]
@@ -1,3 +1,10 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import ProductResult
+
+
+@admin.register(ProductResult)
+class ProductResultAdmin(admin.ModelAdmin):
+    list_display = ('product', 'year', 'aoi_hash', 'mapid', 'duration', 'created', 'expires')
+    list_filter = ('product', 'year')
+    search_fields = ('aoi_hash', 'mapid')
@@ -0,0 +1,181 @@
+import functools
+import gzip
+import hashlib
+import json
+import logging
+import math
+import os
+import threading
+from collections import namedtuple
+from datetime import datetime, timezone
+
+import numpy as np
+from cachetools import LRUCache, cached
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+# Meters per degree of latitude
+METERS_PER_DEGREE = 111320
+
+PreparedAoi = namedtuple('PreparedAoi', ['geometry', 'canonical', 'hash', 'vertices', 'simplified_vertices'])
+
+
+def douglas_peucker(points, tolerance):
+    '''
+    Return the mask of the vertices of a line kept by the
+    Douglas-Peucker simplification. The distances of all the
+    vertices of a span are computed at once with NumPy
+    '''
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+
+    spans = [(0, len(points) - 1)]
+    while spans:
+        start, end = spans.pop()
+        if end - start < 2:
+            continue
+
+        a, b = points[start], points[end]
+        inner = points[start + 1:end]
+        dx, dy = b - a
+        length = math.hypot(dx, dy)
+        if length == 0:     # Closed ring: distance to the first vertex
+            distances = np.hypot(inner[:, 0] - a[0], inner[:, 1] - a[1])
+        else:
+            distances = np.abs(dx * (inner[:, 1] - a[1]) - dy * (inner[:, 0] - a[0])) / length
+
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = start + 1 + farthest
+            keep[split] = True
+            spans.append((start, split))
+            spans.append((split, end))
+
+    return keep
+
+
+def signed_area(ring):
+    '''Shoelace formula: positive for counter-clockwise rings'''
+    x, y = ring[:, 0], ring[:, 1]
+    return 0.5 * float(np.dot(x[:-1], y[1:]) - np.dot(x[1:], y[:-1]))
+
+
+def normalize_ring(ring, tolerance, decimals, exterior):
+    '''
+    Quantize, deduplicate, rotate to a canonical starting vertex,
+    simplify and orient a linear ring (counter-clockwise exteriors
+    and clockwise holes, as in RFC 7946). Returns None for rings
+    that collapse
+    '''
+    ring = np.round(np.asarray(ring, dtype=float)[:, :2], decimals)
+
+    # Open the ring & drop consecutive duplicate vertices
+    if len(ring) > 1 and (ring[0] == ring[-1]).all():
+        ring = ring[:-1]
+    if len(ring) > 1:
+        ring = ring[np.concatenate(([True], (np.diff(ring, axis=0) != 0).any(axis=1)))]
+        if len(ring) > 1 and (ring[0] == ring[-1]).all():
+            ring = ring[:-1]
+    if len(ring) < 3:
+        return None
+
+    # Start from the lowest (x, y) vertex, so that equal rings serialize equally
+    first = np.lexsort((ring[:, 1], ring[:, 0]))[0]
+    ring = np.roll(ring, -first, axis=0)
+    ring = np.vstack((ring, ring[:1]))
+
+    simplified = ring[douglas_peucker(ring, tolerance)]
+    if len(simplified) >= 4:
+        ring = simplified
+    elif exterior:
+        pass    # Keep the exterior of small polygons unsimplified
+    else:
+        return None
+
+    if (signed_area(ring) > 0) != exterior:
+        ring = ring[::-1]
+    return ring
+
+
+def _raw_hash(aoi, tolerance=None):
+    geometry = aoi.get('geometry', aoi)
+    raw = json.dumps(geometry['coordinates'], separators=(',', ':'))
+    return (geometry['type'], hashlib.sha1(raw.encode('utf-8')).hexdigest(), tolerance)
+
+
+@cached(LRUCache(maxsize=256), key=_raw_hash, lock=threading.Lock())
+def prepare_aoi(aoi, tolerance=None):
+    '''
+    Simplify & normalize the geometry of a GeoJSON Feature (or a
+    bare Polygon/MultiPolygon) before it is submitted to Earth
+    Engine. The tolerance defaults to half the output resolution,
+    coordinates are quantized well below it, and the canonical
+    serialization of the result is a stable cache key
+    '''
+    geometry = aoi.get('geometry', aoi)
+    polygons = geometry['coordinates']
+    if geometry['type'] == 'Polygon':
+        polygons = [polygons]
+
+    if tolerance is None:
+        tolerance = settings.GEE_AOI_SIMPLIFY_TOLERANCE / METERS_PER_DEGREE
+    decimals = int(math.ceil(-math.log10(tolerance / 10)))
+
+    vertices, multipolygon = 0, []
+    for polygon in polygons:
+        rings = []
+        for i, ring in enumerate(polygon):
+            vertices += len(ring)
+            ring = normalize_ring(ring, tolerance, decimals, exterior=(i == 0))
+            if ring is not None:
+                rings.append(ring.tolist())
+        if rings:
+            multipolygon.append(rings)
+
+    prepared = {'type': 'MultiPolygon', 'coordinates': multipolygon}
+    canonical = json.dumps(prepared, sort_keys=True, separators=(',', ':'))
+    simplified_vertices = sum(len(ring) for polygon in multipolygon for ring in polygon)
+
+    logger.info('AOI simplified: %d -> %d vertices (tolerance %.2e deg)',
+                vertices, simplified_vertices, tolerance)
+    return PreparedAoi(prepared, canonical, hashlib.sha1(canonical.encode('utf-8')).hexdigest(),
+                       vertices, simplified_vertices)
+
+
+def canonical_geometry(aoi):
+    '''
+    Return the simplified geometry of a GeoJSON Feature (or a
+    bare geometry) serialized in a stable, whitespace-free form
+    '''
+    return prepare_aoi(aoi).canonical
+
+
+def aoi_hash(aoi):
+    '''
+    Hash the canonical geometry of an AOI, so that it
+    can be used as part of a cache key
+    '''
+    return prepare_aoi(aoi).hash
+
+
+class DefaultAoi:
+    '''
+    The default AOI (default_geojson.json), loaded once per
+    process and kept serialized & gzipped, ready to be served
+    '''
+    def __init__(self, path):
+        with open(path, encoding='utf-8') as f:
+            self.feature = json.load(f)
+
+        self.json = json.dumps(self.feature, separators=(',', ':')).encode('utf-8')
+        self.gzip = gzip.compress(self.json, mtime=0)
+        self.etag = hashlib.sha1(self.json).hexdigest()
+        self.last_modified = datetime.fromtimestamp(os.path.getmtime(path), timezone.utc)
+
+
+@functools.lru_cache(maxsize=None)
+def default_aoi():
+    '''Return the default AOI of the process'''
+    return DefaultAoi(settings.GEE_DEFAULT_AOI)
@@ -2,4 +2,5 @@ from django.apps import AppConfig
 
 
 class GeeConfig(AppConfig):
+    default_auto_field = 'django.db.models.AutoField'
     name = 'gee'
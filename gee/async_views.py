@@ -0,0 +1,101 @@
+import asyncio
+import functools
+import json
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.http import JsonResponse
+
+from .batch import merge_products, run_product
+from . import views
+from .views import landsat_product, unknown_products, water_quality_product
+
+
+# Earth Engine calls are blocking HTTP requests: run them on a dedicated
+# thread pool, so that they never block the event loop
+_executor = ThreadPoolExecutor(max_workers=settings.GEE_MAX_ASYNC_REQUESTS,
+                               thread_name_prefix='gee-async')
+
+# asyncio primitives are bound to an event loop
+_semaphores = weakref.WeakKeyDictionary()
+
+
+def _semaphore():
+    '''Return the semaphore capping in-flight EE computations of the running loop'''
+    loop = asyncio.get_running_loop()
+    if loop not in _semaphores:
+        _semaphores[loop] = asyncio.Semaphore(settings.GEE_MAX_ASYNC_REQUESTS)
+    return _semaphores[loop]
+
+
+async def _offload(func, *args):
+    async with _semaphore():
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, functools.partial(func, *args))
+
+
+async def _compute(request, compute, app):
+    data = json.loads(request.body.decode("utf-8"))
+    aoi = data['aoi']
+    year = data['year']
+    layers = data['layers']
+    error = unknown_products(layers, app)
+    if error:
+        return error
+
+    if isinstance(layers, list):
+        products = list(dict.fromkeys(layers))
+        reports = await asyncio.gather(
+            *(_offload(run_product, product, compute, aoi, year) for product in products)
+        )
+        return JsonResponse(merge_products(
+            (product, *report) for product, report in zip(products, reports)
+        ))
+
+    gee_data = await _offload(compute, layers, aoi, year)
+    return JsonResponse(gee_data)
+
+
+async def asyncEE(request):
+    '''Native async version of views.asyncEE: the EE calls are
+    offloaded to a thread pool, so that a single ASGI process
+    can serve many in-flight requests'''
+    if request.method == 'POST':      # Async data loading with custom params
+        return await _compute(request, landsat_product, 'landsat')
+
+
+async def water_quality_asyncEE(request):
+    '''Native async version of views.water_quality_asyncEE'''
+    if request.method == 'POST':      # Async data loading with custom params
+        return await _compute(request, water_quality_product, 'water_quality')
+
+
+async def zonal(request):
+    '''
+    Native async version of views.zonal. The statistics are
+    computed on the thread pool & sent at once: a streamed
+    response would iterate the blocking reductions on the loop
+    '''
+    if request.method == 'POST':
+        data = json.loads(request.body.decode("utf-8"))
+        return await _offload(views.zonal_response, data, True)
+
+
+async def pixels(request):
+    '''Native async version of views.pixels'''
+    return await _offload(views.pixels, request)
+
+
+async def tile(request, mapid, z, x, y):
+    '''Native async version of views.tile: tile misses wait for the
+    upstream server on the thread pool, not one at a time'''
+    return await _offload(views.tile, request, mapid, z, x, y)
+
+
+# csrf_exempt wraps views in a sync function on Django 4.0,
+# which would hide the coroutine from the request handler
+asyncEE.csrf_exempt = True
+water_quality_asyncEE.csrf_exempt = True
+zonal.csrf_exempt = True
+pixels.csrf_exempt = True
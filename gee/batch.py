@@ -0,0 +1,96 @@
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+# Shared by all requests of the process, so that the number of
+# products computed concurrently stays bounded under load
+_executor = ThreadPoolExecutor(max_workers=settings.GEE_MAX_PARALLEL_PRODUCTS,
+                               thread_name_prefix='gee-product')
+
+
+def run_product(product, compute, aoi, year):
+    '''
+    Compute a single product and report its latency & error,
+    instead of letting one failing product fail the request
+    '''
+    start = time.perf_counter()
+    try:
+        layers = compute(product, aoi, year)
+        error = None
+    except Exception as e:
+        logger.exception('Product %s failed', product)
+        layers = {}
+        error = str(e)
+
+    return layers, {
+        'layers': list(layers),
+        'latency': round(time.perf_counter() - start, 3),
+        'error': error,
+    }
+
+
+def merge_products(results):
+    '''
+    Merge the (product, layers, report) results of several
+    products into a single response
+    '''
+    layers, report = {}, {}
+    for product, product_layers, product_report in results:
+        layers.update(product_layers)
+        report[product] = product_report
+
+    return {
+        'layers': layers,
+        'products': report,
+    }
+
+
+def run_products(products, compute, aoi, year):
+    '''
+    Compute several products concurrently on the shared thread
+    pool, and merge their layers into a single response
+    '''
+    futures = {}
+    for product in products:
+        if product not in futures:
+            futures[product] = _executor.submit(run_product, product, compute, aoi, year)
+
+    return merge_products(
+        (product, *future.result()) for product, future in futures.items()
+    )
+
+
+def stream_products(products, compute, aoi, year):
+    '''
+    Compute several products concurrently on the shared thread
+    pool, yielding the records of a stream: the layers of each
+    product as soon as it is ready, a heartbeat while waiting,
+    and a final summary
+    '''
+    start = time.perf_counter()
+    futures = {
+        _executor.submit(run_product, product, compute, aoi, year): product
+        for product in dict.fromkeys(products)
+    }
+
+    report = {}
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, timeout=settings.GEE_STREAM_HEARTBEAT, return_when=FIRST_COMPLETED)
+        if not done:
+            yield {'type': 'heartbeat', 'elapsed': round(time.perf_counter() - start, 3)}
+        for future in done:
+            product = futures[future]
+            layers, report[product] = future.result()
+            if report[product]['error'] is None:
+                yield {'type': 'layers', 'product': product, 'layers': layers,
+                       'latency': report[product]['latency']}
+            else:
+                yield {'type': 'error', 'product': product, 'error': report[product]['error']}
+
+    yield {'type': 'summary', 'products': report, 'elapsed': round(time.perf_counter() - start, 3)}
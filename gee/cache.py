@@ -0,0 +1,94 @@
+import hashlib
+import json
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DatabaseError
+
+from . import ee_client
+from .aoi import aoi_hash
+from .metrics import cache_lookup
+from .models import ProductResult
+from .products import LAYERS
+
+
+logger = logging.getLogger(__name__)
+
+
+def params_hash(params):
+    '''
+    Hash a JSON-serializable set of parameters (e.g. visual
+    parameters) independently of the order of its keys
+    '''
+    serialized = json.dumps(params, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(serialized.encode('utf-8')).hexdigest()
+
+
+def cache_key(product, aoi, year, params=None):
+    '''
+    Build the cache key of a product computed for an AOI & year
+    '''
+    return 'gee:{}:{}:{}:{}'.format(product, aoi_hash(aoi), year, params_hash(params))
+
+
+def gee_cache():
+    '''Return the cache backend that holds Earth Engine results'''
+    return caches[settings.GEE_CACHE]
+
+
+def stored_result(product, aoi, year, params=None):
+    '''Read an unexpired result through the result store'''
+    if not settings.GEE_RESULT_STORE:
+        return None
+    try:
+        result = ProductResult.lookup(product, aoi_hash(aoi), year, params_hash(params))
+    except DatabaseError:
+        logger.warning('Could not read the result of %s', product, exc_info=True)
+        return None
+    cache_lookup('store', result is not None)
+    return result
+
+
+def store_result(product, aoi, year, params, ttl, duration, mapid='', stats=None):
+    '''Persist a result computed on Earth Engine in the result store'''
+    if not settings.GEE_RESULT_STORE:
+        return
+    try:
+        ProductResult.store(product, aoi_hash(aoi), year, params_hash(params), ttl, duration,
+                            mapid=mapid, stats=stats)
+    except DatabaseError:
+        # The result is still cached: failing to persist it must not fail the request
+        logger.warning('Could not store the result of %s', product, exc_info=True)
+
+
+def get_map_id(image, vis_params, product, aoi, year):
+    '''
+    Return the map ID of an ee.Image rendered with vis_params, and
+    when it expires (Unix time), reusing the one already issued for
+    the same product, AOI, year & visual parameters while it has not
+    expired: from the cache, or else from the result store (which
+    survives restarts)
+    '''
+    cache = gee_cache()
+    key = cache_key(product, aoi, year, vis_params)
+    ttl = LAYERS[product].ttl if product in LAYERS else settings.GEE_MAPID_TTL
+
+    tiles = cache.get(key)
+    if cache_lookup('mapid', tiles is not None):
+        return tiles
+
+    result = stored_result(product, aoi, year, vis_params)
+    if result is not None and result.mapid:
+        mapid, ttl = result.mapid, result.ttl
+    else:
+        start = time.perf_counter()
+        mapid = ee_client.get_map_id(image, vis_params)['mapid']
+        store_result(product, aoi, year, vis_params, ttl, time.perf_counter() - start, mapid=mapid)
+
+    tiles = {'mapid': mapid, 'expires': int(time.time()) + ttl}
+    cache.set(key, tiles, ttl)
+    # Remember which product a map ID renders, to find its seeded tiles
+    cache.set('gee:mapid:{}'.format(mapid), key, ttl)
+    return tiles
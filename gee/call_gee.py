@@ -1,29 +1,15 @@
 import json
+import threading
 import ee
-from .app_secrets import *
+from cachetools import LRUCache, cached
+from django.conf import settings
+from .aoi import aoi_hash
+from .cache import get_map_id
+from .diagnostics import Diagnostics
+from .products import VIS_PARAMS
+from .service import start_gee_service
+from .stretch import vis_params
 
-email       =   email
-key_file    =   key_file
-credentials =   credentials    
-
-ee.Initialize(credentials)
-
-
-#def pixelValue(image, band,  x, y):
-#    geom = ee.Geometry.Point(x, y)
-
-
-def mean_stddev(image, band):
-    '''
-    Calculate the mean & standard dev for an
-    ee.Image and return it, for display and 
-    visual parameter setting
-    '''
-    stdDev = image.select(band).reduceRegion(ee.Reducer.stdDev()).getInfo()[band]
-    mean = image.select(band).reduceRegion(ee.Reducer.mean()).getInfo()[band]
-    print("Std Dev {} : ".format(band), stdDev)
-    print("Mean {} : ".format(band), mean)
-    return {'mean': mean, 'stddev': stdDev}
 
 def computeNDVI(image) :
     '''
@@ -57,6 +43,13 @@ def computeNDWI(image):
     ndwi = image.normalizedDifference(['B3', 'B5']).rename('ndwi')
     return image.addBands(ndwi).select('ndwi')
 
+def computeIndices(image):
+    '''
+    Apply the NDVI, EVI & NDWI computations on a Landsat-8
+    image and return the image with the 3 index bands
+    '''
+    return computeNDVI(image).addBands(computeEVI(image)).addBands(computeNDWI(image))
+
 def addDate(image):
     '''
     Parse the metadata of an ee.Image and add it as 
@@ -67,36 +60,56 @@ def addDate(image):
 
 
 
+def min_cloud_image(aoi, year):
+    '''
+    Select the image with the minimum cloud coverage of the year
+    '''
+    service = start_gee_service(aoi, year)
+
+    # Sort by Cloud Coverage
+    sortedByCloud = ee.ImageCollection(service['L8'].sort('CLOUD_COVER'))
+    return ee.Image(sortedByCloud.first().clip(service['roi']))
+
+
+def min_cloud_ndvi_image(aoi, year):
+    '''
+    The NDVI of the image with the minimum cloud coverage of the year
+    '''
+    return ee.Image(computeNDVI(min_cloud_image(aoi, year)))
+
+
 def color_composites(aoi, year) -> dict:
     '''
     Compute True & False color composites for the
     day with the minimum cloud coverage of the year
     '''
-    L8  = start_gee_service(aoi, year)['L8']
-    roi = start_gee_service(aoi, year)['roi']
+    L8 = start_gee_service(aoi, year)['L8']
 
-    # Sort by Cloud Coverage
-    sortedByCloud = ee.ImageCollection(L8.sort('CLOUD_COVER'))
+    # Cloud coverage of the scenes, only fetched in diagnostics mode
+    diagnostics = Diagnostics('composites')
+    diagnostics.add('scenes', lambda: L8.size())
+    diagnostics.add('min_cloud', lambda: L8.aggregate_min('CLOUD_COVER'))
+    diagnostics.add('max_cloud', lambda: L8.aggregate_max('CLOUD_COVER'))
 
-    # Select the image with the maximum cloud coverage
-    max_cloud = L8.aggregate_max('CLOUD_COVER')
-    print('Max Cloud ::', max_cloud.getInfo())
-   
     # Select the image with the minimum cloud coverage
-    minCloud = (sortedByCloud.first().clip(roi))
+    minCloud = min_cloud_image(aoi, year)
 
     # Create True & False color composites
-    minCloud_TC_tiles = ee.Image(minCloud).getMapId({ 'bands': ['B4', 'B3', 'B2'], 'max':  25000, 'gamma': [0.95, 1.1, 1] } )   #ee.Image({sorter}).getMapId({visParams})
-    minCloud_FC_tiles = ee.Image(minCloud).getMapId({ 'bands': ['B5', 'B4', 'B3'], 'max':  22000, 'gamma': [0.95, 1.1, 1] } )
+    minCloud_TC_tiles = get_map_id(ee.Image(minCloud), VIS_PARAMS['min_cloud_tc'], 'min_cloud_tc', aoi, year)   #ee.Image({sorter}).getMapId({visParams})
+    minCloud_FC_tiles = get_map_id(ee.Image(minCloud), VIS_PARAMS['min_cloud_fc'], 'min_cloud_fc', aoi, year)
+
+    diagnostics.report()
 
     return {
         'min_cloud_tc': {
             'label': 'True Color Composite',
-            'url': minCloud_TC_tiles['mapid']
+            'url': minCloud_TC_tiles['mapid'],
+            'expires': minCloud_TC_tiles['expires'],
         },
         'min_cloud_fc': {
             'label': 'False Color Composite',
-            'url': minCloud_FC_tiles['mapid']
+            'url': minCloud_FC_tiles['mapid'],
+            'expires': minCloud_FC_tiles['expires'],
         }
     }
 
@@ -105,209 +118,159 @@ def min_cloud_ndvi (aoi, year):
     Compute the NDVI for the day with the minimum
     cloud coverage of the year
     '''
-    L8  = start_gee_service(aoi, year)['L8']
-    roi = start_gee_service(aoi, year)['roi']
-
-    # Sort by Cloud Coverage
-    sortedByCloud = ee.ImageCollection(L8.sort('CLOUD_COVER'))
-
-    # Select the image with the minimum cloud coverage
-    minCloud = (sortedByCloud.first().clip(roi))
-
     # Compute NDVI for the day with the minimum cloud cover
-    minCloud_NDVI = computeNDVI(minCloud)
+    minCloud_NDVI = min_cloud_ndvi_image(aoi, year)
 
-    # Calculate mean & stddev, to set the visualisation parameters 
-    mean = mean_stddev(minCloud_NDVI, 'ndvi')['mean']
-    stdDev = mean_stddev(minCloud_NDVI, 'ndvi')['stddev']
-
-    minCloud_NDVI_tiles = ee.Image(minCloud_NDVI).getMapId({'bands':['ndvi'], 'max': (mean+2*stdDev), 'min':  (mean-2*stdDev), 'palette': ['red','green']})
+    # Stretch the palette to the 2-98% percentiles of the NDVI (cached histogram)
+    vis = vis_params('min_cloud_ndvi', minCloud_NDVI, aoi, year)
+    minCloud_NDVI_tiles = get_map_id(minCloud_NDVI, vis, 'min_cloud_ndvi', aoi, year)
 
     return {
         'min_cloud_ndvi': {
             'label': 'Landsat 8, Minimum Cloud Coverage: NDVI',
-            'url': minCloud_NDVI_tiles['mapid']
+            'url': minCloud_NDVI_tiles['mapid'],
+            'expires': minCloud_NDVI_tiles['expires'],
         }
     }
 
 
-def max_ndvi(aoi, year):
+@cached(LRUCache(maxsize=settings.GEE_SERVICE_CACHE_SIZE),
+        key=lambda aoi, year: (aoi_hash(aoi), str(year)), lock=threading.Lock())
+def max_indices_image(aoi, year):
     '''
-    Compute the maximum values of 3 common indices:
-    NDVI, EVI, NDWI
+    Compute the maximum NDVI, EVI & NDWI per pixel with a single
+    map over the time series and a single temporal reduction.
+    Returns one multi-band image (ndvi_max, evi_max, ndwi_max),
+    memoized so that every max_* layer shares the same graph
     '''
-    L8  = start_gee_service(aoi, year)['L8']
-    roi = start_gee_service(aoi, year)['roi']
+    L8 = start_gee_service(aoi, year)['L8']
 
-    # Map NDVI, NDWI & EVI computation functions over the whole time series
-    NDVI = L8.map(computeNDVI)
+    # Map the fused NDVI, EVI & NDWI computation over the whole time series
+    indices = L8.map(computeIndices)
 
-    
-    #Calculate max NDVI/EVI/NDWI per pixel in the time series, via temporal reduction
-    maxNDVI = NDVI.reduce(ee.Reducer.max())
-
-
-    maxNDVI_tiles = ee.Image(maxNDVI).getMapId({'bands':['ndvi_max'], 'max': -0.5, 'min': 1, 'palette': ['red','green']})    
+    # Calculate max NDVI/EVI/NDWI per pixel in the time series, via temporal reduction
+    return ee.Image(indices.reduce(ee.Reducer.max()))
 
 
+def max_index_layer(layer, label, aoi, year):
+    '''
+    Render one band of the fused max indices image, stretched
+    to percentiles of its values (one histogram for all 3 bands)
+    '''
+    image = max_indices_image(aoi, year)
+    tiles = get_map_id(image, vis_params(layer, image, aoi, year), layer, aoi, year)
     return {
-        'max_ndvi': {
-            'label': 'Max NDVI/pixel ',
-            'url': maxNDVI_tiles['mapid']
+        layer: {
+            'label': label,
+            'url': tiles['mapid'],
+            'expires': tiles['expires'],
         },
     }
 
-def max_evi(aoi, year):
+
+def max_ndvi(aoi, year):
     '''
-    Compute the maximum values of 3 common indices:
-    NDVI, EVI, NDWI
+    Compute the maximum NDVI per pixel in the time series
     '''
-    L8  = start_gee_service(aoi, year)['L8']
-    roi = start_gee_service(aoi, year)['roi']
+    return max_index_layer('max_ndvi', 'Max NDVI/pixel ', aoi, year)
 
-    # Map EVI computation functions over the whole time series
-    EVI  = L8.map(computeEVI)
-    
-    #Calculate max EVI per pixel in the time series, via temporal reduction
-    maxEVI  = EVI.reduce(ee.Reducer.max())
-    maxEVI_tiles  = ee.Image(maxEVI).getMapId({'bands':['evi_max'],   'max': -0.5, 'min': 1, 'palette': ['red','green']})
-
-    return {
-        'max_evi': {
-            'label': 'Max EVI/pixel ',
-            'url': maxEVI_tiles['mapid']
-        },
-    }
+def max_evi(aoi, year):
+    '''
+    Compute the maximum EVI per pixel in the time series
+    '''
+    return max_index_layer('max_evi', 'Max EVI/pixel ', aoi, year)
 
 def max_ndwi(aoi, year):
     '''
-    Compute the maximum values of 3 common indices:
-    NDVI, EVI, NDWI
+    Compute the maximum NDWI per pixel in the time series
     '''
-    L8  = start_gee_service(aoi, year)['L8']
-    roi = start_gee_service(aoi, year)['roi']
-
-    # Map  NDWI  computation functions over the whole time series
-    NDWI = L8.map(computeNDWI)
-    
-    #Calculate max NDWI per pixel in the time series, via temporal reduction
-    maxNDWI = NDWI.reduce(ee.Reducer.max())
-    maxNDWI_tiles = ee.Image(maxNDWI).getMapId({'bands':['ndwi_max'], 'max': -0.5, 'min': 1, 'palette': ['red','green']})
+    return max_index_layer('max_ndwi', 'Max NDWI/pixel ', aoi, year)
 
+def max_indices(aoi, year):
+    '''
+    Compute the maximum values of 3 common indices:
+    NDVI, EVI, NDWI, from a single evaluation
+    '''
     return {
-        'max_ndwi': {
-            'label': 'Max NDWI/pixel ',
-            'url': maxNDWI_tiles['mapid']
-        },
+        **max_ndvi(aoi, year),
+        **max_evi(aoi, year),
+        **max_ndwi(aoi, year),
     }
 
 
 
 
 
-def doy_max_ndvi(aoi, year):
+@cached(LRUCache(maxsize=settings.GEE_SERVICE_CACHE_SIZE),
+        key=lambda aoi, year: (aoi_hash(aoi), str(year)), lock=threading.Lock())
+def doy_max_image(aoi, year):
     '''
-    Compute the Day Of the Year (DOY) on which the
-    maximum values of NDVI, EVI & NDWI occured
+    Compute the Day Of the Year (DOY) on which the maximum
+    values of NDVI, EVI & NDWI occured, with a single map over
+    the time series (indices & DOY) and a single reduction:
+    one max reducer per index, carrying the DOY along as a
+    tie-breaker output. Returns one multi-band image
+    (ndvi_doy, evi_doy, ndwi_doy), memoized per AOI & year
     '''
-    L8  = start_gee_service(aoi, year)['L8']
+    L8 = start_gee_service(aoi, year)['L8']
 
-    # Map NDVI, NDWI & EVI computation functions over the whole time series
-    NDVI = L8.map(computeNDVI)
- 
-    # Map the NDVI ImageCollection to addDate, then temporally reduce it.
-    DoyMaxNdvi = NDVI.map(addDate).qualityMosaic('ndvi').select('DOY')
-    DoyMaxNdvi_tiles = ee.Image(DoyMaxNdvi).getMapId({'bands':['DOY'],  'max': 365, 'min': 1, 'palette': ['white', 'blue','green','yellow','red']})           
-            
+    # Add the indices & the DOY band once per image
+    series = L8.map(lambda image: addDate(computeIndices(image)))
 
-    return {
-        'doy_max_ndvi' :{
-            'label':'Max NDVI: Day-of-Year',
-            'url'  : DoyMaxNdvi_tiles['mapid']
-        }
-    }
+    # Each reducer consumes an (index, DOY) pair of bands
+    inputs = series.select(
+        ['ndvi', 'DOY', 'evi', 'DOY', 'ndwi', 'DOY'],
+        ['ndvi', 'ndvi_DOY', 'evi', 'evi_DOY', 'ndwi', 'ndwi_DOY'],
+    )
+    reducer = (ee.Reducer.max(2).setOutputs(['ndvi_max', 'ndvi_doy'])
+                .combine(ee.Reducer.max(2).setOutputs(['evi_max', 'evi_doy']))
+                .combine(ee.Reducer.max(2).setOutputs(['ndwi_max', 'ndwi_doy'])))
 
-def doy_max_evi(aoi, year):
+    return ee.Image(inputs.reduce(reducer)).select(['ndvi_doy', 'evi_doy', 'ndwi_doy'])
+
+
+def doy_max_layer(layer, label, aoi, year):
     '''
-    Compute the Day Of the Year (DOY) on which the
-    maximum values of NDVI, EVI & NDWI occured
+    Render one band of the DOY-of-maximum image
     '''
-    L8  = start_gee_service(aoi, year)['L8']
-
-    # Map EVI computation functions over the whole time series
-    EVI  = L8.map(computeEVI)
-    
-    # Map the date from the image metadata to each pixel and
-    # calculate max EVI per pixel in the time series, via temporal reduction
-    DoyMaxEvi = EVI.map(addDate).qualityMosaic('evi').select('DOY')
-    DoyMaxEvi_tiles  = ee.Image(DoyMaxEvi).getMapId({'bands':['DOY'],   'max': 365, 'min': 1, 'palette': ['white', 'blue','green','yellow','red']})           
-       
+    tiles = get_map_id(doy_max_image(aoi, year), VIS_PARAMS[layer], layer, aoi, year)
     return {
-        'doy_max_evi' :{
-            'label':'Max EVI: Day-of-Year',
-            'url'  : DoyMaxEvi_tiles['mapid']
+        layer: {
+            'label': label,
+            'url': tiles['mapid'],
+            'expires': tiles['expires'],
         }
     }
 
 
-def doy_max_ndwi(aoi, year):
+def doy_max_ndvi(aoi, year):
     '''
     Compute the Day Of the Year (DOY) on which the
-    maximum values of NDWI occured
+    maximum value of NDVI occured
     '''
-    L8  = start_gee_service(aoi, year)['L8']
-
-    # Map EVI computation functions over the whole time series
-    NDWI  = L8.map(computeEVI)
-    
-    # Map the date from the image metadata to each pixel and
-    # calculate max EVI per pixel in the time series, via temporal reduction
-    DoyMaxNdvi = NDWI.map(addDate).qualityMosaic('evi').select('DOY')
-    DoyMaxNdwi_tiles  = ee.Image(DoyMaxNdvi).getMapId({'bands':['DOY'],   'max': 365, 'min': 1, 'palette': ['white', 'blue','green','yellow','red']})           
+    return doy_max_layer('doy_max_ndvi', 'Max NDVI: Day-of-Year', aoi, year)
 
-    return {
-        'doy_max_evi' :{
-            'label':'Max EVI: Day-of-Year',
-            'url'  : DoyMaxNdwi_tiles['mapid']
-        }
-    }
-
-
-
-
-
-
-def start_gee_service(aoi, year):
-    ''' 
-    Authenticate against EE with a Service Account,
-    Initialize an EE server-side script and return the 
-    client-side objects for different evaluation methods
+def doy_max_evi(aoi, year):
     '''
+    Compute the Day Of the Year (DOY) on which the
+    maximum value of EVI occured
+    '''
+    return doy_max_layer('doy_max_evi', 'Max EVI: Day-of-Year', aoi, year)
 
-    title = aoi['properties']['NAME']
-    polygon = aoi['geometry']['coordinates']
-  
-    
-    #roi = ee.Geometry.Point(22.754573960700434, 37.63424498161601).buffer(7500)
-    roi = ee.Geometry.MultiPolygon(polygon)
-    
-
-    L8 = (ee.ImageCollection("LANDSAT/LC08/C02/T1")
-            .filter(ee.Filter.date('{}-01-01'.format(year), '{}-12-31'.format(year)))
-            .filter(ee.Filter.lt('CLOUD_COVER', 20))
-            .filterBounds(roi)      
-            .map(lambda x: x.clip(roi))  # Crop to AOI
-          )
-
-    # Calibration: DNs->Radiance->At-Sensor Reflectance
-    # This step is needed for comparative analysis of time series
-    L8.map(ee.Algorithms.Landsat.calibratedRadiance)
-    L8.map(ee.Algorithms.Landsat.TOA)
+def doy_max_ndwi(aoi, year):
+    '''
+    Compute the Day Of the Year (DOY) on which the
+    maximum value of NDWI occured
+    '''
+    return doy_max_layer('doy_max_ndwi', 'Max NDWI: Day-of-Year', aoi, year)
 
+def doy_max_indices(aoi, year):
+    '''
+    Compute the Day Of the Year (DOY) on which the maximum
+    values of NDVI, EVI & NDWI occured, from a single evaluation
+    '''
     return {
-            'L8': L8,
-            'roi': roi
-            } 
-
-
-
+        **doy_max_ndvi(aoi, year),
+        **doy_max_evi(aoi, year),
+        **doy_max_ndwi(aoi, year),
+    }
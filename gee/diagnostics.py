@@ -0,0 +1,42 @@
+import logging
+import numbers
+
+import ee
+from django.conf import settings
+
+from . import ee_client
+from .metrics import DIAGNOSTICS
+
+
+logger = logging.getLogger(__name__)
+
+
+class Diagnostics:
+    '''
+    Debug-only metadata of a product (max cloud cover, number of
+    scenes...). Values are added as functions building EE objects,
+    which are only called when GEE_DIAGNOSTICS is on; they are then
+    fetched together with a single ee.Dictionary getInfo
+    '''
+    def __init__(self, product):
+        self.product = product
+        self.values = {}
+
+    def add(self, name, value):
+        if settings.GEE_DIAGNOSTICS:
+            self.values[name] = value
+
+    def report(self):
+        '''Fetch the values, then log them & export the numeric ones as metrics'''
+        if not self.values:
+            return None
+
+        values = ee_client.get_info(
+            ee.Dictionary({name: value() for name, value in self.values.items()}), 'diagnostics')
+
+        logger.info('Diagnostics of %s: %s', self.product,
+                    ' '.join('{}={}'.format(k, v) for k, v in values.items()))
+        for name, value in values.items():
+            if isinstance(value, numbers.Number):
+                DIAGNOSTICS.labels(self.product, name).set(value)
+        return values
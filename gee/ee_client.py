@@ -0,0 +1,144 @@
+import fcntl
+import json
+import logging
+import os
+import random
+import re
+import time
+
+from django.conf import settings
+
+from . import ee_session
+from .metrics import EE_CALL_SECONDS, EE_CALLS, EE_RETRIES, IN_FLIGHT
+
+
+logger = logging.getLogger(__name__)
+
+# Errors worth retrying: rate limiting (HTTP 429) & transient server errors
+_RETRYABLE = re.compile(
+    r'\b429\b|too many requests|rate limit|quota exceeded|'
+    r'\b50[0234]\b|internal error|backend error|service unavailable|deadline exceeded',
+    re.IGNORECASE,
+)
+
+
+class TokenBucket:
+    '''
+    Token bucket rate limiter whose state lives in a file, so
+    that it is shared by all the gunicorn workers of the host.
+    The file is locked while a token is taken
+    '''
+    def __init__(self, path, rate, capacity):
+        self.path = path
+        self.rate = rate
+        self.capacity = capacity
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def _take(self):
+        '''Take a token, or return the seconds to wait for the next one'''
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            state = f.read()
+            now = time.time()
+            tokens, stamp = json.loads(state) if state else (self.capacity, now)
+
+            tokens = min(self.capacity, tokens + (now - stamp) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / self.rate
+
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps([tokens, now]))
+        return wait
+
+    def acquire(self):
+        '''Block until a token is available'''
+        wait = self._take()
+        while wait:
+            time.sleep(wait)
+            wait = self._take()
+
+
+_bucket = None
+
+
+def bucket():
+    '''Return the rate limiter shared by every EE call of the process'''
+    global _bucket
+    if _bucket is None:
+        _bucket = TokenBucket(settings.GEE_RATE_LIMIT_FILE,
+                              settings.GEE_RATE_LIMIT, settings.GEE_RATE_LIMIT_BURST)
+    return _bucket
+
+
+def is_retryable(error):
+    '''Whether an EE error is transient (rate limiting or 5xx)'''
+    return bool(_RETRYABLE.search(str(error)))
+
+
+def backoff(retry):
+    '''Exponential backoff with full jitter, in seconds'''
+    return random.uniform(0, min(settings.GEE_RETRY_MAX_DELAY,
+                                 settings.GEE_RETRY_BASE_DELAY * 2 ** retry))
+
+
+def initialize():
+    '''
+    Initialize Earth Engine (once per process): its round trips
+    are rate limited & retried like those of the other EE calls
+    '''
+    if not ee_session.initialized():
+        _retry('initialize', ee_session.initialize)
+
+
+def call(call_type, func, *args, **kwargs):
+    '''
+    Run a blocking EE call (getInfo, getMapId...) once the rate
+    limiter allows it, retrying transient errors with backoff
+    '''
+    initialize()
+    return _retry(call_type, func, *args, **kwargs)
+
+
+def _retry(call_type, func, *args, **kwargs):
+    retries = 0
+    while True:
+        bucket().acquire()
+        start = time.perf_counter()
+        try:
+            with IN_FLIGHT.labels('ee_call').track_inprogress():
+                result = func(*args, **kwargs)
+            _observe(call_type, 'ok', start)
+            break
+        except Exception as e:
+            _observe(call_type, 'error', start)
+            if retries >= settings.GEE_MAX_RETRIES or not is_retryable(e):
+                raise
+            delay = backoff(retries)
+            logger.warning('EE %s failed (%s), retry %d in %.2fs', call_type, e, retries + 1, delay)
+            time.sleep(delay)
+            retries += 1
+            EE_RETRIES.labels(call_type).inc()
+
+    if retries:
+        logger.info('EE %s succeeded after %d retries', call_type, retries)
+    return result
+
+
+def _observe(call_type, status, start):
+    EE_CALLS.labels(call_type, status).inc()
+    EE_CALL_SECONDS.labels(call_type).observe(time.perf_counter() - start)
+
+
+def get_info(obj, call_type='getInfo'):
+    '''Rate limited & retried ee.ComputedObject.getInfo()'''
+    return call(call_type, obj.getInfo)
+
+
+def get_map_id(image, vis_params):
+    '''Rate limited & retried ee.Image.getMapId()'''
+    return call('getMapId', image.getMapId, vis_params)
@@ -0,0 +1,68 @@
+import logging
+import os
+import threading
+import time
+
+import ee
+
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+# Process in which Earth Engine was initialized
+_pid = None
+# Seconds the last initialization took
+init_latency = None
+
+
+def _transport():
+    '''
+    Return a pooled (urllib3-backed) HTTP transport for the EE
+    client, or None to let it use its default one
+    '''
+    try:
+        import httplib2shim
+        return httplib2shim.Http()
+    except (ImportError, AttributeError):   # httplib2shim does not support Python >= 3.10
+        return None
+
+
+def initialized():
+    '''Whether Earth Engine was initialized in this process'''
+    return _pid == os.getpid()
+
+
+def initialize():
+    '''
+    Authenticate against EE with the Service Account, once per
+    process and on first use, so that neither importing the app
+    nor `manage.py check` touch the network. Workers forked from
+    an initialized process re-initialize with their own transport
+    '''
+    global _pid, init_latency
+    if initialized():
+        return
+
+    with _lock:
+        if initialized():
+            return
+
+        from .app_secrets import credentials
+
+        start = time.perf_counter()
+        if _pid is not None:
+            ee.Reset()
+        ee.Initialize(credentials, http_transport=_transport())
+        init_latency = time.perf_counter() - start
+        _pid = os.getpid()
+
+    logger.info('Earth Engine initialized in %.3fs (pid %d)', init_latency, _pid)
+
+
+def _after_fork():
+    # The lock may have been held by another thread at fork time
+    global _lock
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork)
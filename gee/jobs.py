@@ -0,0 +1,107 @@
+import hashlib
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from .cache import cache_key, gee_cache
+from .ee_client import backoff
+from .locks import locked
+from .products import PRODUCTS
+
+
+logger = logging.getLogger(__name__)
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+# Long running products are computed here, off the request workers
+_executor = ThreadPoolExecutor(max_workers=settings.GEE_JOB_WORKERS, thread_name_prefix='gee-job')
+
+
+def job_key(job_id):
+    return 'gee:job:{}'.format(job_id)
+
+
+def get_job(job_id):
+    '''Return the state of a job, or None if it is unknown (or expired)'''
+    return gee_cache().get(job_key(job_id))
+
+
+def save_job(job, ttl=None, **changes):
+    job.update(changes, updated=time.time())
+    gee_cache().set(job_key(job['id']), job, ttl or settings.GEE_JOB_TTL)
+    return job
+
+
+def result_ttl(products, layers):
+    '''
+    Seconds the result of a job stays valid: until the first of
+    its map IDs expires (they may have been issued long before the
+    job ran), else for the shortest map ID TTL of its products
+    '''
+    expires = [layer['expires'] for layer in layers.values() if 'expires' in layer]
+    if not expires:
+        return min([settings.GEE_JOB_TTL] + [PRODUCTS[product].ttl for product in products])
+    return max(1, min(settings.GEE_JOB_TTL, int(min(expires) - time.time())))
+
+
+def is_lost(job):
+    '''Whether a job was left unfinished, e.g. by a restarted worker'''
+    return (job['state'] == FAILED or job['state'] in (QUEUED, RUNNING)
+            and time.time() - job['updated'] > settings.GEE_JOB_STALE_AFTER)
+
+
+def submit(products, compute, aoi, year, app):
+    '''
+    Submit the computation of products for an AOI & year, and
+    return the job. Jobs are identified by what they compute, so
+    an identical job queued, running or done (in any worker) is
+    returned instead of being submitted again
+    '''
+    products = list(dict.fromkeys(products))
+    job_id = hashlib.sha1(cache_key(
+        'job:{}:{}'.format(app, ','.join(products)), aoi, year).encode('utf-8')).hexdigest()
+
+    now = time.time()
+    job = {
+        'id': job_id, 'app': app, 'products': products, 'year': year,
+        'state': QUEUED, 'progress': 0, 'attempts': 0,
+        'submitted': now, 'updated': now, 'result': None, 'error': None,
+    }
+    # cache.add is not atomic on every backend: queue it under a lock
+    with locked('job:{}'.format(job_id)):
+        existing = get_job(job_id)
+        if existing is not None and not is_lost(existing):
+            return existing
+        save_job(job)
+
+    submitted = dict(job)
+    _executor.submit(run, job, compute, aoi, year)
+    return submitted
+
+
+def run(job, compute, aoi, year):
+    '''Compute the products of a job, retrying failures with backoff'''
+    start = time.perf_counter()
+    while True:
+        save_job(job, state=RUNNING, progress=0, attempts=job['attempts'] + 1)
+        try:
+            layers = {}
+            for i, product in enumerate(job['products']):
+                layers.update(compute(product, aoi, year))
+                save_job(job, progress=round((i + 1) / len(job['products']), 3))
+            break
+        except Exception as e:
+            if job['attempts'] >= settings.GEE_JOB_MAX_ATTEMPTS:
+                logger.exception('Job %s failed', job['id'])
+                save_job(job, state=FAILED, error=str(e))
+                return
+            delay = backoff(job['attempts'])
+            logger.warning('Job %s failed (%s), retry in %.2fs', job['id'], e, delay)
+            save_job(job, error=str(e))
+            time.sleep(delay)
+
+    # Once its map IDs expire, the job is submitted again
+    save_job(job, ttl=result_ttl(job['products'], layers), state=DONE, result=layers, error=None,
+             duration=round(time.perf_counter() - start, 3))
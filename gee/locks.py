@@ -0,0 +1,35 @@
+import fcntl
+import hashlib
+import os
+from contextlib import contextmanager
+
+from django.conf import settings
+
+
+def lock_file(key):
+    '''
+    Open the lock file of a key. Like the rate limiter state, it
+    lives on the local disk, so that its flock is exclusive among
+    all the gunicorn workers of the host (cache.add is only atomic
+    on some cache backends, e.g. not on the file based one)
+    '''
+    os.makedirs(settings.GEE_LOCK_DIR, exist_ok=True)
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return open(os.path.join(settings.GEE_LOCK_DIR, digest + '.lock'), 'a')
+
+
+def try_lock(f):
+    '''Take the lock of an open lock file, if no other worker holds it'''
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+
+@contextmanager
+def locked(key):
+    '''Hold the lock of a key, waiting for it if need be'''
+    with lock_file(key) as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from gee.models import ProductResult
+
+
+class Command(BaseCommand):
+    help = 'Delete the expired map IDs & statistics from the result store'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count the expired results')
+
+    def handle(self, *args, **options):
+        expired = ProductResult.objects.filter(expires__lte=timezone.now())
+        if options['dry_run']:
+            self.stdout.write('{} expired results'.format(expired.count()))
+            return
+
+        deleted, _ = expired.delete()
+        self.stdout.write(self.style.SUCCESS('Deleted {} expired results'.format(deleted)))
@@ -0,0 +1,127 @@
+import json
+import os
+import shutil
+import subprocess
+
+import yaml
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from gee.cache import gee_cache
+from gee.tiles import SEED_GRID, seed_path
+
+
+def bbox(aoi):
+    '''Return the [minx, miny, maxx, maxy] bounding box of a GeoJSON AOI'''
+    xs, ys = [], []
+
+    def walk(coordinates):
+        if isinstance(coordinates[0], (int, float)):
+            xs.append(coordinates[0])
+            ys.append(coordinates[1])
+        else:
+            for c in coordinates:
+                walk(c)
+
+    walk(aoi['geometry']['coordinates'])
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+
+class Command(BaseCommand):
+    help = ('Pre-render the tiles of Earth Engine products for an AOI & year into '
+            'local MBTiles caches with MapProxy, so that the tile proxy serves them from disk')
+
+    def add_arguments(self, parser):
+        parser.add_argument('year', type=int)
+        parser.add_argument('--aoi', default=settings.GEE_DEFAULT_AOI,
+                            help='GeoJSON Feature of the AOI (default: the default AOI)')
+        parser.add_argument('--products', nargs='+', default=['composites'],
+                            help='Products to seed (default: composites)')
+        parser.add_argument('--zoom', nargs=2, type=int, default=[8, 14], metavar=('FROM', 'TO'),
+                            help='Zoom levels to seed (default: 8 14)')
+        parser.add_argument('--concurrency', type=int, default=4,
+                            help='Number of parallel seeding processes')
+        parser.add_argument('--continue', dest='resume', action='store_true',
+                            help='Resume an interrupted seeding')
+
+    def handle(self, *args, **options):
+        from gee.products import PRODUCTS
+        from gee.views import compute_product
+
+        seed = shutil.which('mapproxy-seed')
+        if seed is None:
+            raise CommandError('mapproxy-seed not found, is MapProxy installed?')
+
+        with open(options['aoi'], encoding='utf-8') as f:
+            aoi = json.load(f)
+        year = options['year']
+
+        # Compute the products, which also registers the product of each map ID
+        layers = {}
+        for name in options['products']:
+            product = PRODUCTS.get(name)
+            if product is None:
+                raise CommandError('Unknown product: {}'.format(name))
+            layers.update(compute_product(name, product.apps[0], aoi, year))
+
+        sources, caches = {}, {}
+        for name, layer in layers.items():
+            product_key = gee_cache().get('gee:mapid:{}'.format(layer['url']))
+            if product_key is None:
+                raise CommandError('Unknown map ID of layer {}'.format(name))
+
+            sources[name] = {
+                'type': 'tile',
+                'grid': 'GLOBAL_WEBMERCATOR',
+                'url': '{}/{}/tiles/%(z)s/%(x)s/%(y)s'.format(settings.GEE_TILE_UPSTREAM, layer['url']),
+                'transparent': True,
+            }
+            caches[name] = {
+                'sources': [name],
+                'grids': [SEED_GRID],
+                # One MBTiles file per zoom level, with tile timestamps
+                'cache': {'type': 'sqlite', 'directory': seed_path(product_key)},
+            }
+
+        os.makedirs(settings.GEE_SEED_DIR, exist_ok=True)
+        proxy_conf = os.path.join(settings.GEE_SEED_DIR, 'mapproxy.yaml')
+        seed_conf = os.path.join(settings.GEE_SEED_DIR, 'seed.yaml')
+
+        with open(proxy_conf, 'w') as f:
+            yaml.safe_dump({
+                'services': {'tms': {}},
+                'layers': [{'name': name, 'title': layer['label'], 'sources': [name]}
+                           for name, layer in layers.items()],
+                'caches': caches,
+                'sources': sources,
+                'grids': {SEED_GRID: {'base': 'GLOBAL_WEBMERCATOR', 'origin': 'sw'}},
+            }, f)
+
+        zoom_from, zoom_to = options['zoom']
+        with open(seed_conf, 'w') as f:
+            yaml.safe_dump({
+                'seeds': {
+                    'aoi': {
+                        'caches': list(caches),
+                        'coverages': ['aoi'],
+                        'levels': {'from': zoom_from, 'to': zoom_to},
+                        # Only render the tiles missing from the cache
+                        'refresh_before': {'time': '1970-01-01T00:00:00'},
+                    },
+                },
+                'coverages': {'aoi': {'bbox': bbox(aoi), 'srs': 'EPSG:4326'}},
+            }, f)
+
+        command = [
+            seed, '-f', proxy_conf, '-s', seed_conf, '--seed', 'aoi',
+            '-c', str(options['concurrency']),
+            '--progress-file', os.path.join(settings.GEE_SEED_DIR, 'seed.progress'),
+        ]
+        if options['resume']:
+            command.append('--continue')
+
+        self.stdout.write('Seeding {} for {}, zoom levels {}-{}'.format(
+            ', '.join(layers), year, zoom_from, zoom_to))
+        if subprocess.call(command) != 0:
+            raise CommandError('mapproxy-seed failed')
+        self.stdout.write(self.style.SUCCESS('Seeded {} layers'.format(len(layers))))
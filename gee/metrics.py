@@ -0,0 +1,49 @@
+import os
+
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge,
+                               Histogram, generate_latest, multiprocess)
+
+
+# Products take from a fraction of a second (cached) to minutes
+PRODUCT_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+PRODUCT_SECONDS = Histogram(
+    'gee_product_seconds', 'Latency of the products computed for requests',
+    ['app', 'product', 'status'], buckets=PRODUCT_BUCKETS)
+EE_CALLS = Counter(
+    'gee_ee_calls', 'Earth Engine round trips',
+    ['call_type', 'status'])
+EE_CALL_SECONDS = Histogram(
+    'gee_ee_call_seconds', 'Duration of the Earth Engine round trips',
+    ['call_type'], buckets=PRODUCT_BUCKETS)
+EE_RETRIES = Counter(
+    'gee_ee_retries', 'Earth Engine calls retried after a transient error',
+    ['call_type'])
+CACHE_REQUESTS = Counter(
+    'gee_cache_requests', 'Lookups of the caches of Earth Engine results',
+    ['cache', 'result'])
+DIAGNOSTICS = Gauge(
+    'gee_diagnostic', 'Debug metadata of the products (see GEE_DIAGNOSTICS)',
+    ['product', 'name'], multiprocess_mode='liveall')
+IN_FLIGHT = Gauge(
+    'gee_in_flight', 'Products & Earth Engine calls in progress',
+    ['kind'], multiprocess_mode='livesum')
+
+
+def cache_lookup(cache, hit):
+    '''Count a hit (or a miss) of a cache'''
+    CACHE_REQUESTS.labels(cache, 'hit' if hit else 'miss').inc()
+    return hit
+
+
+def exposition():
+    '''
+    Return the metrics in the Prometheus text format, aggregated
+    over all the workers when PROMETHEUS_MULTIPROC_DIR is set
+    '''
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,37 @@
+# Generated by Django 4.0.4 on 2026-10-18 09:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductResult',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('product', models.CharField(max_length=128)),
+                ('aoi_hash', models.CharField(max_length=40)),
+                ('year', models.IntegerField()),
+                ('params_hash', models.CharField(max_length=40)),
+                ('mapid', models.CharField(blank=True, max_length=255)),
+                ('stats', models.JSONField(blank=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('expires', models.DateTimeField()),
+                ('duration', models.FloatField(help_text='Seconds taken to compute it on Earth Engine', null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='productresult',
+            index=models.Index(fields=['expires'], name='gee_result_expires'),
+        ),
+        migrations.AddConstraint(
+            model_name='productresult',
+            constraint=models.UniqueConstraint(fields=('product', 'aoi_hash', 'year', 'params_hash'), name='gee_result_lookup'),
+        ),
+    ]
@@ -1,3 +1,66 @@
-from django.db import models
+from datetime import timedelta
 
-# Create your models here.
+from django.db import IntegrityError, models
+from django.utils import timezone
+
+
+class ProductResult(models.Model):
+    '''
+    A map ID or statistics computed on Earth Engine, persisted so
+    that they survive worker restarts. Keyed by product (or layer),
+    canonical AOI hash, year & parameters (e.g. visual parameters)
+    '''
+    product = models.CharField(max_length=128)
+    aoi_hash = models.CharField(max_length=40)
+    year = models.IntegerField()
+    params_hash = models.CharField(max_length=40)
+    mapid = models.CharField(max_length=255, blank=True)
+    stats = models.JSONField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    expires = models.DateTimeField()
+    duration = models.FloatField(null=True, help_text='Seconds taken to compute it on Earth Engine')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'aoi_hash', 'year', 'params_hash'],
+                                    name='gee_result_lookup'),
+        ]
+        indexes = [
+            models.Index(fields=['expires'], name='gee_result_expires'),
+        ]
+
+    def __str__(self):
+        return '{} {} {}'.format(self.product, self.year, self.aoi_hash[:8])
+
+    @property
+    def ttl(self):
+        '''Seconds left before it expires'''
+        return max(0, int((self.expires - timezone.now()).total_seconds()))
+
+    @classmethod
+    def lookup(cls, product, aoi_hash, year, params_hash):
+        '''Return the unexpired result of a product, if any'''
+        return cls.objects.filter(
+            product=product, aoi_hash=aoi_hash, year=int(year), params_hash=params_hash,
+            expires__gt=timezone.now(),
+        ).first()
+
+    @classmethod
+    def store(cls, product, aoi_hash, year, params_hash, ttl, duration, mapid='', stats=None):
+        '''
+        Save (or replace) the result of a product, valid for ttl
+        seconds. Single statements rather than update_or_create's
+        transaction, which SQLite fails to lock under concurrency
+        '''
+        key = {'product': product, 'aoi_hash': aoi_hash, 'year': int(year), 'params_hash': params_hash}
+        values = {
+            'mapid': mapid,
+            'stats': stats,
+            'expires': timezone.now() + timedelta(seconds=ttl),
+            'duration': duration,
+        }
+        if not cls.objects.filter(**key).update(**values):
+            try:
+                cls.objects.create(**key, **values)
+            except IntegrityError:     # Stored concurrently by another request
+                cls.objects.filter(**key).update(**values)
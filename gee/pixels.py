@@ -0,0 +1,91 @@
+import logging
+
+import ee
+from django.conf import settings
+
+from . import ee_client
+from .aoi import METERS_PER_DEGREE, aoi_hash
+from .cache import gee_cache
+from .products import VIS_PARAMS, layer_image
+
+
+logger = logging.getLogger(__name__)
+
+
+def grid_step():
+    '''Size of the grid cells values are cached per, in degrees'''
+    return settings.GEE_PIXEL_GRID / METERS_PER_DEGREE
+
+
+def grid_cell(x, y):
+    step = grid_step()
+    return int(round(x / step)), int(round(y / step))
+
+
+def value_key(layer, aoi, year, cell):
+    return 'gee:pixel:{}:{}:{}:{}:{}'.format(layer, aoi_hash(aoi), year, *cell)
+
+
+def sample_cells(aoi, year, layers, cells):
+    '''
+    Sample the bands of several layers at the centers of several
+    grid cells with a single reduceRegions getInfo, on one image
+    stacking the bands of all the layers
+    '''
+    layers = sorted(layers)
+    images, names = [], {}
+    for layer in layers:
+        bands = VIS_PARAMS[layer]['bands']
+        renamed = ['{}__{}'.format(layer, band) for band in bands]
+        images.append(ee.Image(layer_image(layer, aoi, year)).select(bands, renamed))
+        names.update(zip(renamed, ((layer, band) for band in bands)))
+
+    step = grid_step()
+    cells = sorted(cells)
+    points = ee.FeatureCollection([
+        ee.Feature(ee.Geometry.Point(cx * step, cy * step), {'cell': i})
+        for i, (cx, cy) in enumerate(cells)
+    ])
+    samples = ee.Image.cat(images).reduceRegions(
+        collection=points, reducer=ee.Reducer.first(), scale=settings.GEE_PIXEL_GRID)
+    samples = ee_client.get_info(samples.select(['.*'], None, False), 'reduceRegions')
+
+    # Of a single band, the output is only named after the reducer
+    if len(names) == 1:
+        names = {'first': next(iter(names.values()))}
+
+    values = {(layer, cell): {} for layer in layers for cell in cells}
+    for feature in samples['features']:
+        properties = feature['properties']
+        cell = cells[int(properties['cell'])]
+        for name, (layer, band) in names.items():
+            values[(layer, cell)][band] = properties.get(name)
+    return values
+
+
+def pixel_values(aoi, year, layers, points):
+    '''
+    Return the values of the bands of several layers at several
+    (x, y) points. Values are cached per layer, AOI, year & grid
+    cell; the missing ones are sampled with a single EE call. The
+    map pages collect bursts of clicks into one request, for
+    GEE_PIXEL_COALESCE_WINDOW seconds
+    '''
+    cells = [grid_cell(x, y) for x, y in points]
+    keys = {(layer, cell): value_key(layer, aoi, year, cell) for layer in layers for cell in cells}
+    cache = gee_cache()
+    cached = cache.get_many(keys.values())
+    values = {item: cached[key] for item, key in keys.items() if key in cached}
+
+    missing = [item for item in keys if item not in values]
+    if missing:
+        sampled = sample_cells(aoi, year, {layer for layer, cell in missing}, {cell for layer, cell in missing})
+        cache.set_many({
+            value_key(layer, aoi, year, cell): value for (layer, cell), value in sampled.items()
+        }, settings.GEE_STATS_TTL)
+        values.update((item, sampled[item]) for item in missing)
+
+    return [{
+        'x': x, 'y': y,
+        'values': {layer: values[(layer, cell)] for layer in layers},
+    } for (x, y), cell in zip(points, cells)]
@@ -0,0 +1,142 @@
+import functools
+import importlib
+
+from django.conf import settings
+
+
+# Visual parameters of every layer, keyed by layer name
+VIS_PARAMS = {
+    'min_cloud_tc':   {'bands': ['B4', 'B3', 'B2'], 'max': 25000, 'gamma': [0.95, 1.1, 1]},
+    'min_cloud_fc':   {'bands': ['B5', 'B4', 'B3'], 'max': 22000, 'gamma': [0.95, 1.1, 1]},
+    # min & max of the index layers are stretched to percentiles of the
+    # values over the AOI (see stretch.py); these are the defaults
+    'min_cloud_ndvi': {'bands': ['ndvi'], 'min': -0.5, 'max': 1, 'palette': ['red', 'green']},
+    'max_ndvi':       {'bands': ['ndvi_max'], 'min': -0.5, 'max': 1, 'palette': ['red', 'green']},
+    'max_evi':        {'bands': ['evi_max'], 'min': -0.5, 'max': 1, 'palette': ['red', 'green']},
+    'max_ndwi':       {'bands': ['ndwi_max'], 'min': -0.5, 'max': 1, 'palette': ['red', 'green']},
+    'doy_max_ndvi':   {'bands': ['ndvi_doy'], 'max': 365, 'min': 1, 'palette': ['white', 'blue', 'green', 'yellow', 'red']},
+    'doy_max_evi':    {'bands': ['evi_doy'], 'max': 365, 'min': 1, 'palette': ['white', 'blue', 'green', 'yellow', 'red']},
+    'doy_max_ndwi':   {'bands': ['ndwi_doy'], 'max': 365, 'min': 1, 'palette': ['white', 'blue', 'green', 'yellow', 'red']},
+    'ndci_rgb':       {'bands': ['B4', 'B3', 'B2'], 'max': 3500, 'min': 0},
+    'ndci':           {'bands': ['NDCI'], 'max': 0.4, 'min': 0.1, 'palette': ['cyan', 'orange', 'red']},
+}
+
+# Spectral indices computed from Landsat 8 (see call_gee.computeIndices)
+INDICES = ['ndvi', 'evi', 'ndwi']
+
+# The image rendered by every layer, as 'module:function' of (aoi, year);
+# its bands are those of VIS_PARAMS
+LAYER_IMAGES = {
+    'min_cloud_tc':   'gee.call_gee:min_cloud_image',
+    'min_cloud_fc':   'gee.call_gee:min_cloud_image',
+    'min_cloud_ndvi': 'gee.call_gee:min_cloud_ndvi_image',
+    'max_ndvi':       'gee.call_gee:max_indices_image',
+    'max_evi':        'gee.call_gee:max_indices_image',
+    'max_ndwi':       'gee.call_gee:max_indices_image',
+    'doy_max_ndvi':   'gee.call_gee:doy_max_image',
+    'doy_max_evi':    'gee.call_gee:doy_max_image',
+    'doy_max_ndwi':   'gee.call_gee:doy_max_image',
+    'ndci_rgb':       'gee.water_quality_call_gee:s2_image',
+    'ndci':           'gee.water_quality_call_gee:ndci_image',
+}
+
+# Relative cost of a product on Earth Engine
+CHEAP = 'cheap'           # A single image
+MODERATE = 'moderate'     # A single image, and statistics of it
+EXPENSIVE = 'expensive'   # A temporal reduction of the whole collection
+
+
+@functools.lru_cache(maxsize=None)
+def load(function):
+    '''
+    Import a 'module:function' on first use, so that importing
+    the views does not load the Earth Engine code
+    '''
+    module, function = function.split(':')
+    return getattr(importlib.import_module(module), function)
+
+
+def layer_image(layer, aoi, year):
+    '''The image rendered by a layer, for an AOI & year'''
+    return load(LAYER_IMAGES[layer])(aoi, year)
+
+
+class Product:
+    '''
+    An Earth Engine product: the function computing it (imported
+    on first use), the sensor it reads, its relative cost, how
+    long its map IDs are cached, and the layers it returns
+    '''
+    def __init__(self, name, function, label, sensor, cost, layers, apps=('landsat', 'water_quality'),
+                 ttl=None):
+        self.name = name
+        self.function = function
+        self.label = label
+        self.sensor = sensor
+        self.cost = cost
+        self.layers = layers
+        self.apps = apps
+        self.ttl = ttl or settings.GEE_MAPID_TTL
+
+    def compute(self, aoi, year):
+        '''Compute the layers of the product for an AOI & year'''
+        return load(self.function)(aoi, year)
+
+    def describe(self):
+        return {
+            'label': self.label,
+            'sensor': self.sensor,
+            'cost': self.cost,
+            'ttl': self.ttl,
+            'apps': list(self.apps),
+            'layers': {layer: VIS_PARAMS[layer] for layer in self.layers},
+        }
+
+
+PRODUCTS = {product.name: product for product in [
+    Product('composites', 'gee.call_gee:color_composites', 'True & False color composites',
+            'L8', CHEAP, ['min_cloud_tc', 'min_cloud_fc']),
+    Product('min_cloud_ndvi', 'gee.call_gee:min_cloud_ndvi', 'NDVI on least cloudy day',
+            'L8', MODERATE, ['min_cloud_ndvi']),
+    Product('max_ndvi', 'gee.call_gee:max_ndvi', 'Max NDVI per pixel',
+            'L8', EXPENSIVE, ['max_ndvi']),
+    Product('max_evi', 'gee.call_gee:max_evi', 'Max EVI per pixel',
+            'L8', EXPENSIVE, ['max_evi']),
+    Product('max_ndwi', 'gee.call_gee:max_ndwi', 'Max NDWI per pixel',
+            'L8', EXPENSIVE, ['max_ndwi']),
+    Product('max_indices', 'gee.call_gee:max_indices', 'Max NDVI, EVI & NDWI per pixel',
+            'L8', EXPENSIVE, ['max_ndvi', 'max_evi', 'max_ndwi']),
+    Product('doy_max_ndvi', 'gee.call_gee:doy_max_ndvi', 'Max NDVI: Day of the year',
+            'L8', EXPENSIVE, ['doy_max_ndvi']),
+    Product('doy_max_evi', 'gee.call_gee:doy_max_evi', 'Max EVI: Day of the year',
+            'L8', EXPENSIVE, ['doy_max_evi']),
+    Product('doy_max_ndwi', 'gee.call_gee:doy_max_ndwi', 'Max NDWI: Day of the year',
+            'L8', EXPENSIVE, ['doy_max_ndwi']),
+    Product('doy_max_indices', 'gee.call_gee:doy_max_indices', 'Max NDVI, EVI & NDWI: Day of the year',
+            'L8', EXPENSIVE, ['doy_max_ndvi', 'doy_max_evi', 'doy_max_ndwi']),
+    Product('ndci', 'gee.water_quality_call_gee:copernicus_ndci', 'Normalized Difference Chlorophyll Index',
+            'S2', CHEAP, ['ndci_rgb', 'ndci'], apps=('water_quality',)),
+]}
+
+# Product of every layer (the first product returning it)
+LAYERS = {}
+for product in PRODUCTS.values():
+    for layer in product.layers:
+        LAYERS.setdefault(layer, product)
+
+
+def get_product(name, app):
+    '''Return a product available to an app, by its name'''
+    product = PRODUCTS.get(name)
+    if product is None or app not in product.apps:
+        raise ValueError('Unknown product: {}'.format(name))
+    return product
+
+
+def catalogue(app=None):
+    '''Describe the products (of an app), e.g. for the frontend'''
+    return {
+        name: product.describe()
+        for name, product in PRODUCTS.items()
+        if app is None or app in product.apps
+    }
@@ -0,0 +1,65 @@
+import threading
+
+import ee
+from cachetools import LRUCache, cached
+from django.conf import settings
+
+from . import ee_client
+from .aoi import aoi_hash, prepare_aoi
+
+
+# Image collections and the cloud cover property used to filter them
+SENSORS = {
+    'L8': {
+        'collection': 'LANDSAT/LC08/C02/T1',
+        'cloud_cover': 'CLOUD_COVER',
+    },
+    'S2': {
+        'collection': 'COPERNICUS/S2_SR',
+        'cloud_cover': 'CLOUDY_PIXEL_PERCENTAGE',
+    },
+}
+
+_service_cache = LRUCache(maxsize=settings.GEE_SERVICE_CACHE_SIZE)
+_service_lock = threading.Lock()
+
+
+def _service_key(aoi, year, sensor='L8'):
+    return (aoi_hash(aoi), str(year), sensor)
+
+
+@cached(_service_cache, key=_service_key, lock=_service_lock)
+def start_gee_service(aoi, year, sensor='L8'):
+    '''
+    Build the ROI and the filtered, clipped ImageCollection
+    of a sensor for an AOI & year. The result is memoized per
+    (AOI geometry, year, sensor), so every product in the
+    process shares the same client-side objects
+    '''
+    # Simplified, quantized & normalized coordinates
+    polygon = prepare_aoi(aoi).geometry['coordinates']
+    source = SENSORS[sensor]
+
+    ee_client.initialize()
+
+    #roi = ee.Geometry.Point(22.754573960700434, 37.63424498161601).buffer(7500)
+    roi = ee.Geometry.MultiPolygon(polygon)
+
+    collection = (ee.ImageCollection(source['collection'])
+            .filter(ee.Filter.date('{}-01-01'.format(year), '{}-12-31'.format(year)))
+            .filter(ee.Filter.lt(source['cloud_cover'], 20))
+            .filterBounds(roi)
+            .map(lambda x: x.clip(roi))  # Crop to AOI
+          )
+
+    if sensor == 'L8':
+        # Calibration: DNs->Radiance->At-Sensor Reflectance
+        # This step is needed for comparative analysis of time series
+        collection.map(ee.Algorithms.Landsat.calibratedRadiance)
+        collection.map(ee.Algorithms.Landsat.TOA)
+
+    return {
+            sensor: collection,
+            'roi': roi
+            }
+
@@ -0,0 +1,90 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from .cache import gee_cache
+from .locks import lock_file, try_lock
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+    '''An in-progress computation, awaited by identical requests'''
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_lock = threading.Lock()
+_calls = {}
+
+
+def single_flight(key, func, *args):
+    '''
+    Run func(*args) once for all the concurrent calls sharing the
+    same key: within the process, followers wait for the leader's
+    result; across workers, a lock file makes the other workers
+    wait for the result the leader stores in the shared cache
+    '''
+    with _lock:
+        call = _calls.get(key)
+        leader = call is None
+        if leader:
+            call = _calls[key] = _Call()
+
+    if not leader:
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    try:
+        call.result = _across_workers(key, func, *args)
+        return call.result
+    except Exception as e:
+        call.error = e
+        raise
+    finally:
+        with _lock:
+            del _calls[key]
+        call.done.set()
+
+
+def _across_workers(key, func, *args):
+    cache = gee_cache()
+    result_key = 'gee:flight:result:{}'.format(key)
+
+    result = cache.get(result_key)
+    if result is not None:
+        return result
+
+    deadline = time.monotonic() + settings.GEE_SINGLE_FLIGHT_TIMEOUT
+    with lock_file('flight:{}'.format(key)) as lock:
+        acquired = try_lock(lock)
+        while not acquired:
+            # Another worker computes it: wait for its result. If it
+            # fails (the lock is released without a result) or takes
+            # too long, compute it here
+            time.sleep(settings.GEE_SINGLE_FLIGHT_POLL)
+            result = cache.get(result_key)
+            if result is not None:
+                logger.debug('Shared the result of %s computed by another worker', key)
+                return result
+            if time.monotonic() > deadline:
+                break
+            acquired = try_lock(lock)
+
+        if acquired:
+            # The previous holder may have stored it just before releasing the lock
+            result = cache.get(result_key)
+            if result is not None:
+                return result
+
+        # Closing the lock file releases the lock, if this worker holds it
+        result = func(*args)
+        cache.set(result_key, result, settings.GEE_SINGLE_FLIGHT_RESULT_TTL)
+        return result
@@ -0,0 +1,138 @@
+import logging
+import time
+
+import ee
+import numpy as np
+from django.conf import settings
+
+from . import ee_client
+from .aoi import aoi_hash
+from .cache import gee_cache, params_hash, store_result, stored_result
+from .metrics import cache_lookup
+from .products import VIS_PARAMS
+from .service import start_gee_service
+
+
+logger = logging.getLogger(__name__)
+
+# Layers whose palette is stretched to percentiles of their values over
+# the AOI. The histograms of all the bands of an image are computed
+# together, so that e.g. the 3 max_* layers cost a single reduction
+STRETCHED = {
+    'min_cloud_ndvi': {'image': 'min_cloud_ndvi', 'bands': ['ndvi']},
+    'max_ndvi':       {'image': 'max_indices', 'bands': ['ndvi_max', 'evi_max', 'ndwi_max']},
+    'max_evi':        {'image': 'max_indices', 'bands': ['ndvi_max', 'evi_max', 'ndwi_max']},
+    'max_ndwi':       {'image': 'max_indices', 'bands': ['ndvi_max', 'evi_max', 'ndwi_max']},
+}
+
+# Range of the histograms of the indices
+HISTOGRAM_RANGE = (-1, 1)
+
+
+def band_histograms(image, bands, aoi, year, signature):
+    '''
+    Compute fixed-bin histograms of some bands of an ee.Image over
+    the AOI, with a single fixedHistogram reduction. Cached per
+    (image signature, bands, AOI, year), and persisted in the
+    result store. Returns {band: [count per bin]}
+    '''
+    lo, hi = HISTOGRAM_RANGE
+    params = [bands, lo, hi, 'clamped', settings.GEE_STRETCH_BINS, settings.GEE_STRETCH_SCALE]
+
+    cache = gee_cache()
+    key = 'gee:histogram:{}:{}:{}:{}'.format(signature, aoi_hash(aoi), year, params_hash(params))
+    histograms = cache.get(key)
+    if cache_lookup('histogram', histograms is not None):
+        return histograms
+
+    product = 'histogram:{}'.format(signature)
+    result = stored_result(product, aoi, year, params)
+    if result is not None and result.stats is not None:
+        cache.set(key, result.stats, result.ttl)
+        return result.stats
+
+    # fixedHistogram drops the values out of [lo, hi), e.g. the EVI of
+    # bright raw DN pixels: clamp them into the first & last bins, so
+    # that the percentiles still count them
+    half_bin = (hi - lo) / settings.GEE_STRETCH_BINS / 2
+    start = time.perf_counter()
+    values = ee_client.get_info(image.select(bands).clamp(lo, hi - half_bin).reduceRegion(
+        reducer=ee.Reducer.fixedHistogram(lo, hi, settings.GEE_STRETCH_BINS),
+        geometry=start_gee_service(aoi, year)['roi'],
+        scale=settings.GEE_STRETCH_SCALE,
+        maxPixels=1e9,
+        bestEffort=True,
+    ), 'reduceRegion')
+
+    # [[bin start, count], ...] per band; None if the band is masked over the AOI
+    histograms = {
+        band: [count for _, count in values[band]] if values.get(band) else [0] * settings.GEE_STRETCH_BINS
+        for band in bands
+    }
+    cache.set(key, histograms, settings.GEE_STATS_TTL)
+    store_result(product, aoi, year, params, settings.GEE_STATS_TTL,
+                 time.perf_counter() - start, stats=histograms)
+    return histograms
+
+
+def bin_edges(bins):
+    lo, hi = HISTOGRAM_RANGE
+    return np.linspace(lo, hi, bins + 1)
+
+
+def percentiles(counts, *q):
+    '''
+    Values at percentiles q of a histogram, interpolated within
+    the bins. None if the histogram is empty
+    '''
+    counts = np.asarray(counts, dtype=float)
+    if counts.sum() <= 0:
+        return None
+    cdf = np.concatenate(([0], np.cumsum(counts))) / counts.sum()
+    return [float(v) for v in np.interp(np.asarray(q) / 100, cdf, bin_edges(len(counts)))]
+
+
+def layer_histogram(layer, image, aoi, year):
+    '''The histogram of the band of a stretched layer'''
+    spec = STRETCHED[layer]
+    signature = '{}:{}'.format(spec['image'], year)
+    return band_histograms(image, spec['bands'], aoi, year, signature)[VIS_PARAMS[layer]['bands'][0]]
+
+
+def vis_params(layer, image, aoi, year):
+    '''
+    Visual parameters of a layer: those of VIS_PARAMS, with the
+    palette of stretched layers spanning the GEE_STRETCH_PERCENTILES
+    of the values of the layer over the AOI. After the histogram is
+    cached, this costs no EE call
+    '''
+    vis = dict(VIS_PARAMS[layer])
+    if layer in STRETCHED:
+        stretch = percentiles(layer_histogram(layer, image, aoi, year), *settings.GEE_STRETCH_PERCENTILES)
+        if stretch is None:
+            logger.warning('Empty histogram of %s, using its default stretch', layer)
+        elif stretch[1] > stretch[0]:
+            vis['min'], vis['max'] = [round(v, 4) for v in stretch]
+    return vis
+
+
+def legend(layer, image, aoi, year):
+    '''
+    Legend of a layer: its palette & stretch, and (for stretched
+    layers) the histogram its stretch comes from
+    '''
+    vis = vis_params(layer, image, aoi, year)
+    data = {
+        'bands': vis['bands'],
+        'palette': vis.get('palette'),
+        'min': vis.get('min'),
+        'max': vis.get('max'),
+    }
+    if layer in STRETCHED:
+        counts = layer_histogram(layer, image, aoi, year)
+        data['percentiles'] = list(settings.GEE_STRETCH_PERCENTILES)
+        data['histogram'] = {
+            'edges': bin_edges(len(counts)).round(6).tolist(),
+            'counts': counts,
+        }
+    return data
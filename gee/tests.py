@@ -1,3 +1,705 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.conf import settings
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.http import Http404
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from . import aoi, async_views, batch, cache, ee_client, jobs, locks, pixels, stretch, tiles, timeseries, views, zonal
+from .aoi import aoi_hash
+from .cache import gee_cache, params_hash
+from .models import ProductResult
+from .products import PRODUCTS
+from .singleflight import single_flight
+
+
+PNG = b'\x89PNG\r\n\x1a\n fake tile'
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    '''Stub of the EE tile server: maps named "missing" & "broken" fail'''
+    requests = []
+
+    def do_GET(self):
+        UpstreamHandler.requests.append(self.path)
+        if '/missing/' in self.path:
+            self.send_response(404)
+            self.end_headers()
+        elif '/broken/' in self.path:
+            self.send_response(500)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(PNG)))
+            self.end_headers()
+            self.wfile.write(PNG)
+
+    def log_message(self, *args):
+        pass
+
+
+class TileProxyTests(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), UpstreamHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        settings = override_settings(
+            GEE_TILE_UPSTREAM='http://127.0.0.1:{}'.format(self.server.server_port),
+            GEE_TILE_CACHE_DIR=self.directory,
+            GEE_SEED_DIR=os.path.join(self.directory, 'seed'),
+            GEE_CACHE='default',
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.addCleanup(shutil.rmtree, self.directory)
+        tiles._cache = None
+        self.addCleanup(setattr, tiles, '_cache', None)
+        UpstreamHandler.requests = []
+
+    def test_miss_then_hit(self):
+        url = '/tiles/projects/p/maps/m/3/4/5'
+        first = self.client.get(url)
+        second = self.client.get(url)
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.content, PNG)
+        self.assertEqual(second.content, PNG)
+        self.assertEqual(UpstreamHandler.requests, ['/projects/p/maps/m/tiles/3/4/5'])
+
+        # Also on disk, for the other workers
+        tiles._cache = None
+        self.assertEqual(self.client.get(url).content, PNG)
+        self.assertEqual(len(UpstreamHandler.requests), 1)
+
+    def test_not_modified(self):
+        url = '/tiles/projects/p/maps/m/3/4/5'
+        etag = self.client.get(url)['ETag']
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+    def test_upstream_errors(self):
+        self.assertEqual(self.client.get('/tiles/projects/p/maps/missing/3/4/5').status_code, 404)
+        self.assertEqual(self.client.get('/tiles/projects/p/maps/broken/3/4/5').status_code, 502)
+        # Errors are not cached
+        self.client.get('/tiles/projects/p/maps/broken/3/4/5')
+        self.assertEqual(len(UpstreamHandler.requests), 3)
+
+    def test_unreachable_upstream(self):
+        with override_settings(GEE_TILE_UPSTREAM='http://127.0.0.1:1'):
+            self.assertEqual(self.client.get('/tiles/projects/p/maps/m/3/4/5').status_code, 502)
+
+    def test_invalid_map_id(self):
+        self.assertEqual(self.client.get('/tiles/../etc/passwd/3/4/5').status_code, 404)
+
+    def test_async(self):
+        # Served from the thread pool, so that tile misses overlap
+        request = RequestFactory().get('/tiles/projects/p/maps/m/3/4/5')
+        threads = []
+        with mock.patch.object(tiles, 'get_tile', side_effect=lambda *args: threads.append(
+                threading.current_thread().name) or PNG):
+            response = asyncio.run(async_views.tile(request, 'projects/p/maps/m', 3, 4, 5))
+        self.assertEqual(response.content, PNG)
+        self.assertTrue(threads[0].startswith('gee-async'))
+
+        with self.assertRaises(Http404):
+            asyncio.run(async_views.tile(request, '../etc', 3, 4, 5))
+
+    def test_eviction(self):
+        cache = tiles.TileCache(self.directory, max_bytes=1000, memory_bytes=1000)
+        for i in range(6):
+            cache.set('tile/{}'.format(i), b'x' * 150)
+            os.utime(cache._path('tile/{}'.format(i)), (i, i))
+        self.assertEqual(cache._disk_usage()[0], 900)
+
+        # Over max_bytes: the least recently used tile goes, down to 90%
+        cache.set('tile/6', b'x' * 150)
+        self.assertEqual(cache._disk_usage()[0], 900)
+        self.assertFalse(os.path.exists(cache._path('tile/0')))
+        for i in range(1, 7):
+            self.assertTrue(os.path.exists(cache._path('tile/{}'.format(i))))
+
+
+class AoiTests(SimpleTestCase):
+    EXTERIOR = [[0, 0], [0, 0.01], [0.01, 0.01], [0.01, 0], [0, 0]]    # Clockwise
+    HOLE = [[0.003, 0.003], [0.007, 0.003], [0.007, 0.007], [0.003, 0.007], [0.003, 0.003]]  # Counter-clockwise
+
+    def polygon(self, *rings):
+        return {'type': 'Feature', 'properties': {},
+                'geometry': {'type': 'Polygon', 'coordinates': list(rings)}}
+
+    def test_orientation(self):
+        prepared = aoi.prepare_aoi(self.polygon(self.EXTERIOR, self.HOLE))
+        exterior, hole = prepared.geometry['coordinates'][0]
+        self.assertGreater(aoi.signed_area(np.array(exterior)), 0)
+        self.assertLess(aoi.signed_area(np.array(hole)), 0)
+
+    def test_canonical_hash(self):
+        rotated = self.EXTERIOR[2:-1] + self.EXTERIOR[:3]
+        reversed_ = self.EXTERIOR[::-1]
+        expected = aoi.aoi_hash(self.polygon(self.EXTERIOR))
+        self.assertEqual(aoi.aoi_hash(self.polygon(rotated)), expected)
+        self.assertEqual(aoi.aoi_hash(self.polygon(reversed_)), expected)
+        # A bare geometry hashes like its Feature
+        self.assertEqual(aoi.aoi_hash(self.polygon(rotated)['geometry']), expected)
+        self.assertNotEqual(aoi.aoi_hash(self.polygon(self.EXTERIOR, self.HOLE)), expected)
+
+    def test_collapsed_hole(self):
+        # A hole well below the simplification tolerance
+        hole = [[0.005, 0.005], [0.00501, 0.005], [0.00501, 0.00501], [0.005, 0.005]]
+        prepared = aoi.prepare_aoi(self.polygon(self.EXTERIOR, hole))
+        self.assertEqual(len(prepared.geometry['coordinates'][0]), 1)
+        self.assertEqual(prepared.hash, aoi.aoi_hash(self.polygon(self.EXTERIOR)))
+
+    def test_default_aoi(self):
+        default = aoi.default_aoi()
+        prepared = aoi.prepare_aoi(default.feature)
+        self.assertLess(prepared.simplified_vertices, prepared.vertices // 2)
+        self.assertGreaterEqual(prepared.simplified_vertices, 4)
+        self.assertEqual(json.loads(gzip.decompress(default.gzip)), default.feature)
+
+
+@override_settings(GEE_CACHE='default', GEE_SINGLE_FLIGHT_TIMEOUT=0.05, GEE_SINGLE_FLIGHT_POLL=0.01)
+class SingleFlightTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        settings = override_settings(GEE_LOCK_DIR=directory)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.addCleanup(gee_cache().clear)
+
+    def other_worker(self, key):
+        '''Hold the lock of a key, as another worker would'''
+        lock = locks.lock_file('flight:{}'.format(key))
+        self.addCleanup(lock.close)
+        self.assertTrue(locks.try_lock(lock))
+
+    def is_locked(self, key):
+        with locks.lock_file('flight:{}'.format(key)) as lock:
+            return not locks.try_lock(lock)
+
+    def test_releases_own_lock(self):
+        self.assertEqual(single_flight('a', lambda: 1), 1)
+        self.assertFalse(self.is_locked('a'))
+
+    def test_waits_for_other_worker(self):
+        self.other_worker('b')
+        func = mock.Mock(return_value=3)
+        with override_settings(GEE_SINGLE_FLIGHT_TIMEOUT=5):
+            timer = threading.Timer(0.05, gee_cache().set, ('gee:flight:result:b', 2))
+            timer.start()
+            self.assertEqual(single_flight('b', func), 2)
+        func.assert_not_called()
+
+    def test_keeps_foreign_lock(self):
+        # Another worker holds the lock past the deadline
+        self.other_worker('c')
+        self.assertEqual(single_flight('c', lambda: 2), 2)
+        self.assertTrue(self.is_locked('c'))
+
+
+class TimeseriesTests(SimpleTestCase):
+
+    def test_daily(self):
+        doy = np.array([1, 1, 5, 9])
+        values = np.array([[0.2, 0.], [0.4, 0.], [0.5, 1.], [0.1, 2.]])
+        series = timeseries.daily(doy, values, 10)
+
+        self.assertEqual(series.shape, (10, 2))
+        # Same-day scenes are averaged, gaps interpolated, edges held
+        np.testing.assert_allclose(series[:, 0], [0.3, 0.35, 0.4, 0.45, 0.5, 0.4, 0.3, 0.2, 0.1, 0.1])
+        np.testing.assert_allclose(series[:, 1], [0, 0.25, 0.5, 0.75, 1, 1.25, 1.5, 1.75, 2, 2])
+
+    def test_savitzky_golay(self):
+        x = np.arange(100, dtype=float)
+        # A quadratic is preserved away from the edges
+        quadratic = (0.01 * (x - 50) ** 2)[:, None]
+        smoothed = timeseries.savitzky_golay(quadratic, 11)
+        np.testing.assert_allclose(smoothed[10:-10], quadratic[10:-10], atol=1e-9)
+
+        # Noise is damped
+        noisy = np.sin(x / 15)[:, None] + np.random.default_rng(0).normal(0, 0.1, (100, 1))
+        error = timeseries.savitzky_golay(noisy, 11) - np.sin(x / 15)[:, None]
+        self.assertLess(np.abs(error[10:-10]).mean(), 0.05)
+
+    def test_phenology(self):
+        # A Gaussian season peaking on day 181, seen every 16 days
+        doy = np.arange(1, 366, 16)
+        values = (0.2 + 0.6 * np.exp(-0.5 * ((doy - 181) / 28) ** 2))[:, None]
+        series = timeseries.savitzky_golay(timeseries.daily(doy, values, 365), 31)
+        (metrics,) = timeseries.phenology(series)
+
+        self.assertEqual((metrics['sos'], metrics['pos'], metrics['eos']), (148, 181, 214))
+        self.assertEqual(metrics['length'], 67)
+        self.assertAlmostEqual(metrics['base'], 0.2, places=2)
+        self.assertAlmostEqual(metrics['peak'], 0.8, places=1)
+
+    def test_too_few_days(self):
+        # Three scenes, but of two days only
+        millis = np.array([date(2020, m, d).toordinal() for m, d in ((6, 1), (6, 1), (7, 1))], dtype=float)
+        millis = (millis - date(1970, 1, 1).toordinal()) * 86400000
+        values = np.array([[0.3, 0.2, 0.1], [0.5, 0.3, 0.2], [0.7, 0.4, 0.3]])
+
+        with mock.patch.object(timeseries, 'fetch_series', return_value=(millis, values)):
+            result = timeseries.index_timeseries({}, 2020)
+        self.assertEqual(result['scenes'], 3)
+        self.assertNotIn('phenology', result)
+
+
+class ZonalTests(SimpleTestCase):
+    PARCEL = {'hash': 'h', 'geometry': {'coordinates': []}, 'vertices': 5}
+
+    def reduce(self, indices, properties):
+        response = {'features': [{'properties': dict(hash='h', **properties)}]}
+        with mock.patch.object(zonal, 'ee'), \
+                mock.patch.object(zonal.ee_client, 'get_info', return_value=response):
+            return zonal.reduce_chunk(mock.Mock(), [self.PARCEL], indices, 30)
+
+    def test_single_index(self):
+        stats = self.reduce(['evi'], {'mean': 0.5, 'stdDev': 0.1, 'min': 0.2, 'max': 0.9})
+        self.assertEqual(stats, {'h': {'evi_mean': 0.5, 'evi_stdDev': 0.1, 'evi_min': 0.2, 'evi_max': 0.9}})
+
+    def test_several_indices(self):
+        properties = {'{}_{}'.format(index, s): i for i, index in enumerate(['ndvi', 'ndwi'])
+                      for s in zonal.STATISTICS}
+        stats = self.reduce(['ndvi', 'ndwi'], properties)
+        self.assertEqual(stats, {'h': properties})
+
+
+class JobTests(SimpleTestCase):
+
+    def run_job(self, compute):
+        job = {'id': 'j', 'products': ['composites', 'ndci'], 'attempts': 0}
+        cache = mock.Mock()
+        with mock.patch.object(jobs, 'gee_cache', return_value=cache):
+            jobs.run(job, compute, {}, 2020)
+        self.assertEqual(job['state'], jobs.DONE)
+        # Unfinished jobs are kept for GEE_JOB_TTL
+        self.assertEqual(cache.set.call_args_list[0][0][2], settings.GEE_JOB_TTL)
+        return job, cache.set.call_args_list[-1]
+
+    def test_done_job_expires_with_its_map_ids(self):
+        # A map ID issued long ago (e.g. from the cache) expires soon
+        expires = {'composites': time.time() + 600, 'ndci': time.time() + 3000}
+        job, saved = self.run_job(lambda product, aoi, year: {product: {'url': 'm', 'expires': expires[product]}})
+        self.assertEqual(saved[0][:2], ('gee:job:j', job))
+        self.assertIn(saved[0][2], (599, 600))
+
+    def test_done_job_expires_with_its_products(self):
+        job, saved = self.run_job(lambda product, aoi, year: {product: {}})
+        ttl = min(PRODUCTS['composites'].ttl, PRODUCTS['ndci'].ttl)
+        self.assertLess(ttl, settings.GEE_JOB_TTL)
+        self.assertEqual(saved, mock.call('gee:job:j', job, ttl))
+
+    @override_settings(GEE_CACHE='default')
+    def test_submitted_once(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.addCleanup(gee_cache().clear)
+        aoi = {'type': 'Polygon', 'coordinates': [[[0, 0], [0, 1], [1, 1], [0, 0]]]}
+
+        with override_settings(GEE_LOCK_DIR=directory), mock.patch.object(jobs, '_executor') as executor:
+            threads = [threading.Thread(target=jobs.submit, args=(['composites'], None, aoi, 2020, 'landsat'))
+                       for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        executor.submit.assert_called_once()
+
+
+class PixelTests(SimpleTestCase):
+    CELLS = [(1, 2), (3, 4)]
+
+    def sample(self, layers, properties):
+        response = {'features': [dict(properties=dict(cell=i, **p)) for i, p in enumerate(properties)]}
+        with mock.patch.object(pixels, 'ee'), \
+                mock.patch.object(pixels, 'layer_image'), \
+                mock.patch.object(pixels.ee_client, 'get_info', return_value=response):
+            return pixels.sample_cells({}, 2020, layers, self.CELLS)
+
+    def test_single_band(self):
+        values = self.sample(['ndci'], [{'first': 0.2}, {'first': None}])
+        self.assertEqual(values, {('ndci', (1, 2)): {'NDCI': 0.2}, ('ndci', (3, 4)): {'NDCI': None}})
+
+    @override_settings(GEE_CACHE='default')
+    def test_pixel_values(self):
+        self.addCleanup(gee_cache().clear)
+        aoi = {'type': 'Polygon', 'coordinates': []}
+        step = pixels.grid_step()
+        points = [[step, 2 * step], [3 * step, 4 * step]]
+        def sampled(*layers):
+            return {(layer, cell): {'band': 0.1} for layer in layers for cell in self.CELLS}
+
+        # All the points of a request are sampled at once, then cached
+        with mock.patch.object(pixels, 'sample_cells', return_value=sampled('ndci')) as sample_cells:
+            values = pixels.pixel_values(aoi, 2020, ['ndci'], points)
+            pixels.pixel_values(aoi, 2020, ['ndci'], points[:1])
+        sample_cells.assert_called_once_with(aoi, 2020, {'ndci'}, set(self.CELLS))
+        self.assertEqual(values[1], {'x': 3 * step, 'y': 4 * step, 'values': {'ndci': {'band': 0.1}}})
+
+        # Only the missing layers are sampled
+        with mock.patch.object(pixels, 'sample_cells', return_value=sampled('ndci_rgb')) as sample_cells:
+            pixels.pixel_values(aoi, 2020, ['ndci', 'ndci_rgb'], points)
+        sample_cells.assert_called_once_with(aoi, 2020, {'ndci_rgb'}, set(self.CELLS))
+
+    def test_several_bands(self):
+        values = self.sample(['max_ndvi', 'ndci'], [
+            {'max_ndvi__ndvi_max': 0.8, 'ndci__NDCI': 0.2},
+            {'max_ndvi__ndvi_max': 0.7, 'ndci__NDCI': 0.3},
+        ])
+        self.assertEqual(values[('max_ndvi', (3, 4))], {'ndvi_max': 0.7})
+        self.assertEqual(values[('ndci', (1, 2))], {'NDCI': 0.2})
+
+
+class StretchTests(SimpleTestCase):
+
+    def test_percentiles(self):
+        # Uniform over (-1, 1): percentiles are linear
+        self.assertEqual(stretch.percentiles([1] * 4, 0, 25, 50, 100), [-1, -0.5, 0, 1])
+        np.testing.assert_allclose(stretch.percentiles([1] * 200, 2, 98), [-0.96, 0.96])
+
+        # Interpolated within the bins
+        counts = [0] * 4
+        counts[2] = 10
+        np.testing.assert_allclose(stretch.percentiles(counts, 10, 90), [0.05, 0.45])
+
+        self.assertIsNone(stretch.percentiles([0] * 4, 2, 98))
+
+    @override_settings(GEE_CACHE='default', GEE_RESULT_STORE=False, GEE_STRETCH_BINS=4)
+    def test_clamped_histogram(self):
+        self.addCleanup(gee_cache().clear)
+        image = mock.Mock()
+        response = {'evi_max': [[-1, 1], [-0.5, 0], [0, 2], [0.5, 7]]}
+        with mock.patch.object(stretch, 'ee'), \
+                mock.patch.object(stretch, 'start_gee_service'), \
+                mock.patch.object(stretch.ee_client, 'get_info', return_value=response):
+            histograms = stretch.band_histograms(image, ['evi_max'], {'type': 'Polygon', 'coordinates': []}, 2020, 'test')
+
+        # Out of range values are clamped into the edge bins, not dropped
+        image.select.return_value.clamp.assert_called_once_with(-1, 0.75)
+        self.assertEqual(histograms, {'evi_max': [1, 0, 2, 7]})
+
+
+class AsyncZonalTests(SimpleTestCase):
+    COLLECTION = {'type': 'FeatureCollection', 'features': [{'type': 'Feature'}]}
+
+    def zonal(self, **data):
+        request = RequestFactory().post('/zonal/', dict(aoi=self.COLLECTION, year=2020, **data),
+                                        content_type='application/json')
+        records = [{'id': 0, 'hash': 'h', 'ndvi_mean': 0.5}]
+        with mock.patch.object(views, 'zonal_stats', return_value=iter(records)):
+            return asyncio.run(async_views.zonal(request))
+
+    def test_buffered(self):
+        # Not streamed: ASGI would iterate the reductions on the event loop
+        response = self.zonal(indices=['ndvi'])
+        self.assertFalse(response.streaming)
+        self.assertEqual(json.loads(response.content), {'id': 0, 'hash': 'h', 'ndvi_mean': 0.5})
+
+        response = self.zonal(indices=['ndvi'], format='csv')
+        self.assertEqual(response.content.decode().splitlines()[1], '0,h,0.5,,,,')
+
+    def test_invalid(self):
+        self.assertEqual(self.zonal(composite='mean').status_code, 400)
+
+
+class EeClientTests(SimpleTestCase):
+
+    def setUp(self):
+        for target, attribute in ((ee_client, 'bucket'), (ee_client.time, 'sleep')):
+            patcher = mock.patch.object(target, attribute)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_initialize_retried(self):
+        # A 429 while initializing is retried, like any other EE call
+        initialize = mock.Mock(side_effect=[Exception('Too many requests (429)'), None])
+        with mock.patch.object(ee_client.ee_session, 'initialized', return_value=False), \
+                mock.patch.object(ee_client.ee_session, 'initialize', initialize):
+            ee_client.initialize()
+        self.assertEqual(initialize.call_count, 2)
+        self.assertEqual(ee_client.bucket().acquire.call_count, 2)
+
+    def test_initialize_once(self):
+        with mock.patch.object(ee_client.ee_session, 'initialized', return_value=True), \
+                mock.patch.object(ee_client.ee_session, 'initialize') as initialize:
+            ee_client.initialize()
+        initialize.assert_not_called()
+        ee_client.bucket().acquire.assert_not_called()
+
+    @override_settings(GEE_MAX_RETRIES=3)
+    def test_retries(self):
+        func = mock.Mock(side_effect=[Exception('HTTP 503: service unavailable'), Exception('429'), 'ok'])
+        with mock.patch.object(ee_client.ee_session, 'initialized', return_value=True):
+            self.assertEqual(ee_client.call('getInfo', func, 1, key=2), 'ok')
+        self.assertEqual(func.call_args_list, [mock.call(1, key=2)] * 3)
+        self.assertEqual(ee_client.bucket().acquire.call_count, 3)
+        self.assertEqual(ee_client.time.sleep.call_count, 2)
+
+    @override_settings(GEE_MAX_RETRIES=3)
+    def test_gives_up(self):
+        func = mock.Mock(side_effect=Exception('Too many requests'))
+        with mock.patch.object(ee_client.ee_session, 'initialized', return_value=True):
+            with self.assertRaisesMessage(Exception, 'Too many requests'):
+                ee_client.call('getInfo', func)
+        self.assertEqual(func.call_count, 4)
+
+    def test_other_errors_not_retried(self):
+        func = mock.Mock(side_effect=Exception('Image.select: Band pattern did not match any bands'))
+        with mock.patch.object(ee_client.ee_session, 'initialized', return_value=True):
+            with self.assertRaises(Exception):
+                ee_client.call('getInfo', func)
+        func.assert_called_once()
+        ee_client.time.sleep.assert_not_called()
+
+    def test_is_retryable(self):
+        for message in ('Too many requests (429)', 'Quota exceeded', 'HTTP Error 502', 'Internal error',
+                        'Deadline exceeded', 'Service Unavailable'):
+            self.assertTrue(ee_client.is_retryable(Exception(message)), message)
+        for message in ('Invalid argument', 'HTTP Error 404', 'Collection.first: Empty collection', '5029 pixels'):
+            self.assertFalse(ee_client.is_retryable(Exception(message)), message)
+
+    @override_settings(GEE_RETRY_BASE_DELAY=0.5, GEE_RETRY_MAX_DELAY=3)
+    def test_backoff(self):
+        # Full jitter under an exponential, capped, bound
+        for retry, bound in ((0, 0.5), (1, 1), (2, 2), (3, 3), (10, 3)):
+            with mock.patch.object(ee_client.random, 'uniform', side_effect=lambda lo, hi: hi):
+                self.assertEqual(ee_client.backoff(retry), bound)
+            self.assertTrue(0 <= ee_client.backoff(retry) <= bound)
+
+
+class ProductRequestTests(SimpleTestCase):
+
+    def post(self, view, layers):
+        request = RequestFactory().post('/', {'aoi': {}, 'year': 2020, 'layers': layers},
+                                        content_type='application/json')
+        response = view(request)
+        return asyncio.run(response) if asyncio.iscoroutine(response) else response
+
+    def test_unknown_products(self):
+        # ndci is only offered by the water quality app
+        for view in (views.asyncEE, views.asyncEE_stream, async_views.asyncEE):
+            for layers in ('ndci', ['composites', 'ndci'], 'nope'):
+                response = self.post(view, layers)
+                self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.post(views.water_quality_asyncEE, 'nope').status_code, 400)
+        self.assertEqual(self.post(async_views.water_quality_asyncEE, 'nope').status_code, 400)
+        self.assertIn(b'Unknown product: nope', self.post(views.submit_job, ['nope']).content)
+
+
+class TokenBucketTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'limits', 'bucket.json')
+        self.now = 1000.0
+        patcher = mock.patch.object(ee_client.time, 'time', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst_then_wait(self):
+        bucket = ee_client.TokenBucket(self.path, rate=2, capacity=3)
+        self.assertEqual([bucket._take() for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(bucket._take(), 0.5)
+
+    def test_refill(self):
+        bucket = ee_client.TokenBucket(self.path, rate=2, capacity=3)
+        for _ in range(3):
+            bucket._take()
+        self.now += 1       # 2 tokens
+        self.assertEqual([bucket._take(), bucket._take()], [0, 0])
+        self.assertAlmostEqual(bucket._take(), 0.5)
+
+        # Never more than the capacity
+        self.now += 60
+        self.assertEqual([bucket._take() for _ in range(3)], [0, 0, 0])
+        self.assertGreater(bucket._take(), 0)
+
+    def test_shared_state(self):
+        # Workers share the tokens through the file
+        first = ee_client.TokenBucket(self.path, rate=1, capacity=2)
+        second = ee_client.TokenBucket(self.path, rate=1, capacity=2)
+        self.assertEqual(first._take(), 0)
+        self.assertEqual(second._take(), 0)
+        self.assertAlmostEqual(first._take(), 1)
+
+    def test_acquire_sleeps(self):
+        bucket = ee_client.TokenBucket(self.path, rate=4, capacity=1)
+        bucket.acquire()
+
+        def sleep(seconds):
+            self.now += seconds
+        with mock.patch.object(ee_client.time, 'sleep', side_effect=sleep) as slept:
+            bucket.acquire()
+        slept.assert_called_once_with(0.25)
+
+
+class ResultStoreTests(TestCase):
+    KEY = ('max_ndvi', 'a' * 40, 2020, 'p' * 40)
+
+    def test_store_then_lookup(self):
+        ProductResult.store(*self.KEY, ttl=3600, duration=1.5, mapid='projects/p/maps/m')
+        result = ProductResult.lookup(*self.KEY)
+        self.assertEqual((result.mapid, result.duration), ('projects/p/maps/m', 1.5))
+        self.assertIn(result.ttl, (3599, 3600))
+        self.assertIsNone(ProductResult.lookup('max_evi', *self.KEY[1:]))
+
+    def test_expired(self):
+        ProductResult.store(*self.KEY, ttl=3600, duration=1, mapid='projects/p/maps/m')
+        ProductResult.objects.update(expires=timezone.now() - timedelta(seconds=1))
+        self.assertIsNone(ProductResult.lookup(*self.KEY))
+
+    def test_replace(self):
+        ProductResult.store(*self.KEY, ttl=60, duration=1, mapid='projects/p/maps/old')
+        ProductResult.store(*self.KEY, ttl=3600, duration=2, stats={'ndvi': [1, 2]})
+        self.assertEqual(ProductResult.objects.count(), 1)
+        result = ProductResult.lookup(*self.KEY)
+        self.assertEqual((result.mapid, result.stats, result.duration), ('', {'ndvi': [1, 2]}, 2))
+        self.assertGreater(result.ttl, 60)
+
+    def test_prune(self):
+        ProductResult.store(*self.KEY, ttl=3600, duration=1, mapid='projects/p/maps/m')
+        ProductResult.store('max_evi', *self.KEY[1:], ttl=3600, duration=1, mapid='projects/p/maps/e')
+        ProductResult.objects.filter(product='max_evi').update(expires=timezone.now() - timedelta(seconds=1))
+
+        out = io.StringIO()
+        call_command('prune_results', '--dry-run', stdout=out)
+        self.assertIn('1 expired results', out.getvalue())
+        self.assertEqual(ProductResult.objects.count(), 2)
+
+        call_command('prune_results', stdout=io.StringIO())
+        self.assertEqual(list(ProductResult.objects.values_list('product', flat=True)), ['max_ndvi'])
+
+
+@override_settings(GEE_CACHE='default', GEE_RESULT_STORE=True)
+class StoredMapIdTests(TestCase):
+    AOI = {'type': 'Polygon', 'coordinates': [[[0, 0], [0, 1], [1, 1], [0, 0]]]}
+    VIS = {'bands': ['ndvi_max'], 'min': 0, 'max': 1}
+
+    def setUp(self):
+        self.addCleanup(gee_cache().clear)
+
+    def test_stored_map_id(self):
+        # Issued by another (e.g. restarted) worker, 2 minutes left
+        ProductResult.store('max_ndvi', aoi_hash(self.AOI), 2020, params_hash(self.VIS), ttl=120,
+                            duration=1, mapid='projects/p/maps/stored')
+        with mock.patch.object(cache.ee_client, 'get_map_id') as get_map_id:
+            tiles = cache.get_map_id(mock.Mock(), self.VIS, 'max_ndvi', self.AOI, 2020)
+        get_map_id.assert_not_called()
+        self.assertEqual(tiles['mapid'], 'projects/p/maps/stored')
+        self.assertLessEqual(tiles['expires'], time.time() + 120)
+        self.assertEqual(gee_cache().get('gee:mapid:projects/p/maps/stored'),
+                         cache.cache_key('max_ndvi', self.AOI, 2020, self.VIS))
+
+    def test_issued_map_id(self):
+        with mock.patch.object(cache.ee_client, 'get_map_id', return_value={'mapid': 'projects/p/maps/new'}):
+            tiles = cache.get_map_id(mock.Mock(), self.VIS, 'max_ndvi', self.AOI, 2020)
+        self.assertEqual(tiles['mapid'], 'projects/p/maps/new')
+        result = ProductResult.lookup('max_ndvi', aoi_hash(self.AOI), 2020, params_hash(self.VIS))
+        self.assertEqual(result.mapid, 'projects/p/maps/new')
+
+        # Then from the cache
+        with mock.patch.object(cache.ee_client, 'get_map_id') as get_map_id:
+            self.assertEqual(cache.get_map_id(mock.Mock(), self.VIS, 'max_ndvi', self.AOI, 2020), tiles)
+        get_map_id.assert_not_called()
+
+    def test_database_errors(self):
+        # The store failing must not fail the request
+        with mock.patch.object(ProductResult, 'lookup', side_effect=DatabaseError('locked')), \
+                mock.patch.object(ProductResult, 'store', side_effect=DatabaseError('locked')), \
+                mock.patch.object(cache.ee_client, 'get_map_id', return_value={'mapid': 'projects/p/maps/new'}), \
+                self.assertLogs('gee.cache', 'WARNING') as logs:
+            tiles = cache.get_map_id(mock.Mock(), self.VIS, 'max_ndvi', self.AOI, 2020)
+        self.assertEqual(tiles['mapid'], 'projects/p/maps/new')
+        self.assertEqual(len(logs.records), 2)
+
+
+class BatchTests(SimpleTestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def compute(self, product, aoi, year):
+        self.calls.append(product)
+        if product == 'slow':
+            self.release.wait(5)
+        elif product == 'broken':
+            raise Exception('Band pattern did not match')
+        return {product + '_layer': {'label': product, 'url': 'projects/p/maps/' + product}}
+
+    def test_run_products(self):
+        self.release.set()
+        with self.assertLogs('gee.batch', 'ERROR'):
+            result = batch.run_products(['fast', 'broken', 'fast', 'slow'], self.compute, {}, 2020)
+
+        # A failing product does not fail the others; duplicates are computed once
+        self.assertEqual(sorted(self.calls), ['broken', 'fast', 'slow'])
+        self.assertEqual(list(result['layers']), ['fast_layer', 'slow_layer'])
+        self.assertEqual(list(result['products']), ['fast', 'broken', 'slow'])
+        self.assertEqual(result['products']['broken']['error'], 'Band pattern did not match')
+        self.assertEqual(result['products']['broken']['layers'], [])
+        self.assertEqual(result['products']['fast']['layers'], ['fast_layer'])
+        self.assertIsNone(result['products']['fast']['error'])
+        self.assertGreaterEqual(result['products']['slow']['latency'], 0)
+
+    @override_settings(GEE_STREAM_HEARTBEAT=0.2)
+    def test_stream_products(self):
+        records = []
+        with self.assertLogs('gee.batch', 'ERROR'):
+            for record in batch.stream_products(['slow', 'fast', 'broken', 'fast'], self.compute, {}, 2020):
+                records.append(record)
+                # Heartbeats while the slow product is the only one left
+                if sum(r['type'] == 'heartbeat' for r in records) == 2:
+                    self.release.set()
+
+        types = [record['type'] for record in records]
+        # The ready products first, then heartbeats, the slow one & the summary
+        self.assertEqual(sorted(types[:2]), ['error', 'layers'])
+        self.assertEqual(types[2:], ['heartbeat', 'heartbeat', 'layers', 'summary'])
+
+        fast, slow = [record for record in records if record['type'] == 'layers']
+        self.assertEqual((fast['product'], slow['product']), ('fast', 'slow'))
+        self.assertEqual(slow['layers'], {'slow_layer': {'label': 'slow', 'url': 'projects/p/maps/slow'}})
+        self.assertGreater(slow['latency'], 0.3)
+        self.assertEqual([record for record in records if record['type'] == 'error'],
+                         [{'type': 'error', 'product': 'broken', 'error': 'Band pattern did not match'}])
+
+        summary = records[-1]
+        self.assertEqual(sorted(summary['products']), ['broken', 'fast', 'slow'])
+        self.assertEqual(summary['products']['broken']['error'], 'Band pattern did not match')
+        self.assertGreaterEqual(summary['elapsed'], slow['latency'])
+        self.assertEqual(sorted(self.calls), ['broken', 'fast', 'slow'])
@@ -0,0 +1,192 @@
+import hashlib
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+
+import requests
+from cachetools import LRUCache
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from .cache import gee_cache
+from .metrics import cache_lookup
+
+
+# Map IDs issued by getMapId, e.g. projects/earthengine-legacy/maps/<id>
+MAPID = re.compile(r'^projects/[\w-]+/maps/[\w-]+$')
+
+# Web Mercator grid of the seeded MBTiles, which follow the TMS scheme
+SEED_GRID = 'webmercator_tms'
+
+
+class UpstreamError(Exception):
+    '''The upstream tile server answered with an error'''
+    def __init__(self, status):
+        super().__init__('Upstream tile server returned HTTP {}'.format(status))
+        self.status = status
+
+
+class TileCache:
+    '''
+    Size-bounded tile cache: a small in-memory LRU in front of
+    a directory of tiles. When the directory grows over max_bytes,
+    the least recently used tiles (oldest mtime) are evicted
+    '''
+    def __init__(self, directory, max_bytes, memory_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._memory = LRUCache(maxsize=memory_bytes, getsizeof=len)
+        self._lock = threading.Lock()
+        self._size = None
+
+    def _path(self, key):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest + '.png')
+
+    def get(self, key):
+        with self._lock:
+            data = self._memory.get(key)
+        if data is not None:
+            return data
+
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)  # Mark as recently used
+        except FileNotFoundError:
+            return None
+
+        with self._lock:
+            self._memory[key] = data
+        return data
+
+    def set(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write atomically, concurrent workers may fetch the same tile
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+        with self._lock:
+            self._memory[key] = data
+            if self._size is None:
+                self._size = self._disk_usage()[0]
+            self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _disk_usage(self):
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+        return sum(size for _, size, _ in files), files
+
+    def _evict(self):
+        '''Delete the least recently used tiles, down to 90% of max_bytes'''
+        self._size, files = self._disk_usage()
+        for _, size, path in sorted(files):
+            if self._size <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._size -= size
+
+
+_session = None
+_cache = None
+
+
+def session():
+    '''Return the pooled HTTP session used to fetch upstream tiles'''
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=settings.GEE_TILE_POOL_SIZE)
+        _session.mount('https://', adapter)
+        _session.mount('http://', adapter)
+    return _session
+
+
+def tile_cache():
+    '''Return the tile cache of the process'''
+    global _cache
+    if _cache is None:
+        _cache = TileCache(settings.GEE_TILE_CACHE_DIR,
+                           settings.GEE_TILE_CACHE_MAX_BYTES,
+                           settings.GEE_TILE_MEMORY_CACHE_BYTES)
+    return _cache
+
+
+def get_tile(mapid, z, x, y):
+    '''
+    Return the PNG tile of a map ID, from the cache or
+    else from the Earth Engine tile server
+    '''
+    key = '{}/{}/{}/{}'.format(mapid, z, x, y)
+    cache = tile_cache()
+
+    data = cache.get(key)
+    if not cache_lookup('tile', data is not None):
+        data = seeded_tile(mapid, z, x, y)
+        cache_lookup('seeded_tile', data is not None)
+    if data is None:
+        url = '{}/{}/tiles/{}/{}/{}'.format(settings.GEE_TILE_UPSTREAM, mapid, z, x, y)
+        try:
+            response = session().get(url, timeout=settings.GEE_TILE_TIMEOUT)
+        except requests.RequestException:
+            raise UpstreamError(502)
+        if response.status_code != 200:
+            raise UpstreamError(response.status_code)
+        data = response.content
+        cache.set(key, data)
+
+    return data
+
+
+def seed_path(product_key):
+    '''
+    Return the directory of the MBTiles files (one per zoom level)
+    seeded for a product, given the cache key of its map ID
+    (see cache.get_map_id)
+    '''
+    digest = hashlib.sha1(product_key.encode('utf-8')).hexdigest()
+    return os.path.join(settings.GEE_SEED_DIR, digest)
+
+
+def seeded_tile(mapid, z, x, y):
+    '''
+    Return a tile of a map ID from the MBTiles seeded for
+    its product (see the seed_tiles command), if any
+    '''
+    product_key = gee_cache().get('gee:mapid:{}'.format(mapid))
+    if product_key is None:
+        return None
+
+    path = os.path.join(seed_path(product_key), SEED_GRID, '{}.mbtiles'.format(z))
+    if not os.path.exists(path):
+        return None
+
+    # TMS rows start from the bottom of the grid
+    connection = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+    try:
+        row = connection.execute(
+            'SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+            (z, x, 2 ** z - 1 - y),
+        ).fetchone()
+    finally:
+        connection.close()
+
+    return row[0] if row else None
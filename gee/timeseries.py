@@ -0,0 +1,142 @@
+import logging
+from datetime import date, datetime, timezone
+
+import ee
+import numpy as np
+from django.conf import settings
+
+from . import ee_client
+from .cache import cache_key, gee_cache
+from .products import INDICES
+from .service import start_gee_service
+
+
+logger = logging.getLogger(__name__)
+
+
+def fetch_series(aoi, year, scale=30):
+    '''
+    Fetch the mean NDVI, EVI & NDWI over the AOI of every image of
+    the year, with a single getInfo: the per-image reduceRegion is
+    mapped over the collection and the results are gathered with
+    reduceColumns. Returns the acquisition times (ms) and an
+    (images x indices) array, cached per AOI, year & scale. Images
+    fully masked over the AOI are left out
+    '''
+    cache = gee_cache()
+    key = cache_key('timeseries', aoi, year, {'scale': scale})
+    rows = cache.get(key)
+
+    if rows is None:
+        from .call_gee import computeIndices
+
+        service = start_gee_service(aoi, year)
+        L8 = service['L8']
+        roi = service['roi']
+
+        def image_means(image):
+            means = computeIndices(image).reduceRegion(
+                reducer=ee.Reducer.mean(),
+                geometry=roi,
+                scale=scale,
+                maxPixels=1e9,
+                bestEffort=True,
+            )
+            return ee.Feature(None, means).set('millis', image.get('system:time_start'))
+
+        selectors = ['millis'] + INDICES
+        columns = ee.FeatureCollection(L8.map(image_means)).reduceColumns(
+            ee.Reducer.toList(len(selectors)), selectors)
+        rows = ee_client.get_info(columns, 'reduceColumns')['list']
+        cache.set(key, rows, settings.GEE_STATS_TTL)
+
+    rows = np.array(rows, dtype=float).reshape(-1, len(INDICES) + 1)
+    return rows[:, 0], rows[:, 1:]
+
+
+def daily(doy, values, days):
+    '''
+    Average the values of the same day, then fill the gaps by
+    linear interpolation onto a daily grid (1..days). Returns a
+    (days x indices) array
+    '''
+    unique, inverse = np.unique(doy, return_inverse=True)
+    counts = np.bincount(inverse)
+    means = np.stack([np.bincount(inverse, weights=column) / counts for column in values.T], axis=1)
+
+    grid = np.arange(1, days + 1)
+    return np.stack([np.interp(grid, unique, column) for column in means.T], axis=1)
+
+
+def savitzky_golay(values, window, order=2):
+    '''
+    Smooth the columns of a daily series with a Savitzky-Golay
+    filter: a least-squares polynomial fit over a moving window,
+    applied as a convolution. The edges are padded with their values
+    '''
+    window = min(window | 1, (len(values) - 1) | 1)   # Odd, at most the series
+    half = window // 2
+    order = min(order, window - 1)
+
+    x = np.arange(-half, half + 1)
+    coefficients = np.linalg.pinv(np.vander(x, order + 1, increasing=True))[0]
+
+    padded = np.pad(values, ((half, half), (0, 0)), mode='edge')
+    return np.stack([np.convolve(column, coefficients[::-1], mode='valid') for column in padded.T], axis=1)
+
+
+def phenology(series, threshold=0.5):
+    '''
+    Start, peak & end of season of the columns of a smoothed daily
+    series: the season spans the days around the peak whose value
+    exceeds the base plus a fraction (threshold) of the amplitude
+    '''
+    base = series.min(axis=0)
+    peak = series.argmax(axis=0)
+    amplitude = series.max(axis=0) - base
+    above = series >= base + threshold * amplitude
+
+    days = np.arange(len(series))[:, None]
+    # Last day below the threshold before the peak, first one after it
+    before = np.where(~above & (days < peak), days, -1).max(axis=0)
+    after = np.where(~above & (days > peak), days, len(series)).min(axis=0)
+
+    sos, eos = before + 1, after - 1
+    return [{
+        'sos': int(sos[i]) + 1,
+        'pos': int(peak[i]) + 1,
+        'eos': int(eos[i]) + 1,
+        'length': int(eos[i] - sos[i]) + 1,
+        'base': float(base[i]),
+        'peak': float(series[peak[i], i]),
+        'amplitude': float(amplitude[i]),
+    } for i in range(series.shape[1])]
+
+
+def index_timeseries(aoi, year, window=None, threshold=0.5, scale=30):
+    '''
+    Compute the NDVI, EVI & NDWI time series of an AOI over a year:
+    the regional means of every image, the smoothed & gap-filled
+    daily series, and the phenology metrics of every index
+    '''
+    millis, values = fetch_series(aoi, year, scale)
+    dates = [datetime.fromtimestamp(m / 1000, timezone.utc) for m in millis]
+    result = {
+        'year': year,
+        'scenes': len(dates),
+        'dates': [d.date().isoformat() for d in dates],
+        'means': {index: values[:, i].round(4).tolist() for i, index in enumerate(INDICES)},
+    }
+
+    # Smoothing & phenology need scenes of a few distinct days
+    doy = np.array([d.timetuple().tm_yday for d in dates])
+    if len(np.unique(doy)) < 3:
+        logger.warning('Too few scenes (%d) for the time series of %s', len(dates), year)
+        return result
+
+    days = (date(int(year) + 1, 1, 1) - date(int(year), 1, 1)).days
+    smoothed = savitzky_golay(daily(doy, values, days), window or settings.GEE_TIMESERIES_WINDOW)
+
+    result['smoothed'] = {index: smoothed[:, i].round(4).tolist() for i, index in enumerate(INDICES)}
+    result['phenology'] = dict(zip(INDICES, phenology(smoothed, threshold)))
+    return result
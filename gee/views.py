@@ -1,64 +1,155 @@
 from django.shortcuts import render 
+import csv
+import io
 import json
-import os
-from django.http import JsonResponse
+import hashlib
+import time
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
 
 
-from .call_gee import *
-from .water_quality_call_gee import copernicus_ndci
+from . import jobs, tiles
+from .aoi import default_aoi
+from .batch import run_products, stream_products
+from .cache import cache_key
+from .metrics import IN_FLIGHT, PRODUCT_SECONDS, exposition
+from .pixels import pixel_values
+from .products import LAYER_IMAGES, catalogue, get_product, layer_image
+from .singleflight import single_flight
+from .stretch import legend as layer_legend
+from .timeseries import index_timeseries
+from .zonal import COMPOSITES, columns, zonal_stats
 
 def index(request):
     return render(request, "index.html")
 
 
+def accepts_gzip(request):
+    return 'gzip' in request.headers.get('Accept-Encoding', '')
+
+
+def default_aoi_etag(request):
+    '''The gzipped & identity bodies differ, so do their ETags'''
+    etag = default_aoi().etag
+    return etag + '-gz' if accepts_gzip(request) else etag
+
+
+@condition(etag_func=default_aoi_etag,
+           last_modified_func=lambda request: default_aoi().last_modified)
+def default_aoi_geojson(request):
+    '''Serve the default AOI, gzipped if the browser accepts it'''
+    aoi = default_aoi()
+    if accepts_gzip(request):
+        response = HttpResponse(aoi.gzip, content_type='application/geo+json')
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(aoi.json, content_type='application/geo+json')
+    response['Vary'] = 'Accept-Encoding'
+    response['Cache-Control'] = 'public, max-age={}'.format(settings.GEE_DEFAULT_AOI_MAX_AGE)
+    return response
+
+
+def stream_layers():
+    '''
+    The streaming views are sync (Django 4.0 cannot stream from an
+    async iterator) and would block the event loop under ASGI: there,
+    the map pages use the async JSON views instead
+    '''
+    return not settings.GEE_ASYNC_VIEWS
+
+
+def map_context(**context):
+    '''Context of the map pages: how they fetch the layers, and
+    the milliseconds they collect clicks for before inspecting them'''
+    context.update(stream=stream_layers(),
+                   pixel_window=round(settings.GEE_PIXEL_COALESCE_WINDOW * 1000))
+    return context
+
+
 @csrf_exempt
 def map(request):
 
     if request.method == 'GET':     #Default first time loading of the page
-        f = open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'default_geojson.json'), encoding="utf-8")
-        data = json.load(f)
-        f.close()
-        return render(request, "map.html", {'feature': json.dumps(data)})
+        # The page fetches the default AOI from default_aoi_geojson
+        return render(request, "map.html", map_context(year=json.dumps(settings.GEE_DEFAULT_YEAR)))
 
     elif request.method == 'POST':      # Async data loading with custom params
         import urllib.parse
         data = json.loads( urllib.parse.unquote(request.body.decode('utf-8'))[5:])
         #data = json.loads(request.body.decode('utf-8'))
         
-        return render(request, "map.html", {'feature': json.dumps(data['aoi']), 'year': json.dumps(data['year']) })
+        return render(request, "map.html", map_context(feature=json.dumps(data['aoi']), year=json.dumps(data['year'])))
 
 
     
 
+def compute_product(name, app, aoi, year):
+    '''
+    Compute a product of an app by its name. Identical concurrent
+    requests (same product, AOI & year) share one computation
+    '''
+    product = get_product(name, app)
+
+    start = time.perf_counter()
+    status = 'error'
+    try:
+        with IN_FLIGHT.labels('product').track_inprogress():
+            layers = single_flight(cache_key(product.name, aoi, year), product.compute, aoi, year)
+        status = 'ok'
+        return layers
+    finally:
+        PRODUCT_SECONDS.labels(app, product.name, status).observe(time.perf_counter() - start)
+
+
+def unknown_products(layers, app):
+    '''A 400 response if an app does not offer some of the requested
+    products (a name, or a list of names), else None'''
+    try:
+        for layer in (layers if isinstance(layers, list) else [layers]):
+            get_product(layer, app)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    return None
+
+
+def landsat_product(layers, aoi, year):
+    '''Compute a Landsat 8 product by its name'''
+    return compute_product(layers, 'landsat', aoi, year)
+
+
+def metrics(request):
+    '''Expose the metrics of the EE calls, products & caches to Prometheus'''
+    data, content_type = exposition()
+    return HttpResponse(data, content_type=content_type)
+
+
+def products(request):
+    '''Publish the catalogue of products, with their cost & layers'''
+    return JsonResponse(catalogue(request.GET.get('app')))
+
+
 @csrf_exempt
 def asyncEE(request):
     '''Request and return data asynchronously,
     so as to allow new request to the GEE API 
-    without reloading the web page'''
+    without reloading the web page.
+    'layers' is either a single product, or a list
+    of products computed in parallel'''
     if request.method == 'POST':      # Async data loading with custom params
         data =  json.loads(request.body.decode("utf-8"))
         aoi = data['aoi']
         year = data['year']
         layers = data['layers']
+        error = unknown_products(layers, 'landsat')
+        if error:
+            return error
+
+        if isinstance(layers, list):
+            return JsonResponse(run_products(layers, landsat_product, aoi, year))
 
-        # Check what layers were requested
-        if layers == 'composites':
-            gee_data = color_composites(aoi, year)
-        elif layers == 'min_cloud_ndvi':
-            gee_data = min_cloud_ndvi(aoi, year)
-        elif layers == 'max_ndvi':
-            gee_data = max_ndvi(aoi, year)
-        elif layers == 'max_evi':
-            gee_data = max_evi(aoi, year)
-        elif layers == 'max_ndwi':
-            gee_data = max_ndwi(aoi, year)
-        elif layers == 'doy_max_evi':
-            gee_data = doy_max_evi(aoi, year)
-        elif layers == 'doy_max_ndvi':
-            gee_data = doy_max_ndvi(aoi, year)
-        elif layers == 'doy_max_ndwi':
-            gee_data = doy_max_ndwi(aoi, year)
+        gee_data = landsat_product(layers, aoi, year)
         
         return JsonResponse(gee_data)
 
@@ -69,6 +160,186 @@ def asyncEE(request):
 
 
 
+@csrf_exempt
+def submit_job(request):
+    '''Submit the computation of products as a background job,
+    and return its id (to poll job_status with)'''
+    if request.method == 'POST':
+        data = json.loads(request.body.decode("utf-8"))
+        app = data.get('app', 'landsat')
+        layers = data['layers']
+        if not isinstance(layers, list):
+            layers = [layers]
+        error = unknown_products(layers, app)
+        if error:
+            return error
+
+        compute = water_quality_product if app == 'water_quality' else landsat_product
+        job = jobs.submit(layers, compute, data['aoi'], data['year'], app)
+        return JsonResponse(job, status=202)
+
+
+def job_status(request, job_id):
+    '''The state, progress & (once done) the layers of a job'''
+    job = jobs.get_job(job_id)
+    if job is None:
+        raise Http404('Unknown job')
+    return JsonResponse(job)
+
+
+@csrf_exempt
+def pixels(request):
+    '''Inspect the values of several layers at several points
+    (e.g. a burst of map clicks), with a single EE call'''
+    if request.method == 'POST':
+        data = json.loads(request.body.decode("utf-8"))
+        layers, points = data['layers'], data['points']
+        unknown = [layer for layer in layers if layer not in LAYER_IMAGES]
+        if unknown:
+            return HttpResponseBadRequest('Unknown layers: {}'.format(', '.join(unknown)))
+        if len(points) > settings.GEE_PIXEL_MAX_POINTS:
+            return HttpResponseBadRequest('At most {} points per request'.format(settings.GEE_PIXEL_MAX_POINTS))
+
+        return JsonResponse({'points': pixel_values(data['aoi'], data['year'], layers, points)})
+
+
+@csrf_exempt
+def legend(request):
+    '''Legends of layers: palette, stretch & the histogram of the
+    values over the AOI (default: the default AOI & year)'''
+    if request.method == 'POST':
+        data = json.loads(request.body.decode("utf-8"))
+        aoi = data.get('aoi') or default_aoi().feature
+        year = data.get('year') or settings.GEE_DEFAULT_YEAR
+        unknown = [layer for layer in data['layers'] if layer not in LAYER_IMAGES]
+        if unknown:
+            return HttpResponseBadRequest('Unknown layers: {}'.format(', '.join(unknown)))
+
+        return JsonResponse({
+            layer: layer_legend(layer, layer_image(layer, aoi, year), aoi, year)
+            for layer in data['layers']
+        })
+
+
+@csrf_exempt
+def timeseries(request):
+    '''The NDVI, EVI & NDWI time series of an AOI over a year,
+    smoothed, with the phenology metrics of each index'''
+    if request.method == 'POST':
+        data = json.loads(request.body.decode("utf-8"))
+        return JsonResponse(index_timeseries(
+            data['aoi'], data['year'],
+            window=data.get('window'),
+            threshold=data.get('threshold', 0.5),
+        ))
+
+
+def csv_rows(fieldnames, records):
+    '''Serialize records as CSV, one row at a time'''
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames)
+    writer.writeheader()
+    for record in records:
+        writer.writerow(record)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+@csrf_exempt
+def zonal(request):
+    '''Stream the zonal statistics of the parcels of a
+    FeatureCollection, as NDJSON or CSV (format=csv)'''
+    if request.method == 'POST':
+        return zonal_response(json.loads(request.body.decode("utf-8")))
+
+
+def zonal_response(data, buffered=False):
+    '''
+    The response of a zonal statistics request: streamed, or
+    buffered whole (for the async view, as Django 4.0 cannot
+    stream from an async iterator)
+    '''
+    collection = data['aoi']
+    if collection.get('type') != 'FeatureCollection' or not collection.get('features'):
+        return HttpResponseBadRequest('A FeatureCollection of parcels is required')
+    if len(collection['features']) > settings.GEE_ZONAL_MAX_FEATURES:
+        return HttpResponseBadRequest('At most {} parcels per request'.format(settings.GEE_ZONAL_MAX_FEATURES))
+    if data.get('composite', 'median') not in COMPOSITES:
+        return HttpResponseBadRequest('Unknown composite: {}'.format(data['composite']))
+
+    indices = data.get('indices')
+    records = zonal_stats(collection, data['year'], indices, data.get('composite', 'median'))
+    response_class = HttpResponse if buffered else StreamingHttpResponse
+
+    if data.get('format') == 'csv':
+        response = response_class(csv_rows(columns(indices), records), content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="zonal_{}.csv"'.format(data['year'])
+    else:
+        response = response_class((json.dumps(record) + '\n' for record in records),
+                                  content_type='application/x-ndjson')
+    if not buffered:
+        response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def stream_response(request, compute, app):
+    '''
+    Stream the layers of the requested products as NDJSON,
+    one record per product as soon as it is ready
+    '''
+    data = json.loads(request.body.decode("utf-8"))
+    layers = data['layers']
+    if not isinstance(layers, list):
+        layers = [layers]
+    error = unknown_products(layers, app)
+    if error:
+        return error
+
+    records = stream_products(layers, compute, data['aoi'], data['year'])
+    response = StreamingHttpResponse((json.dumps(record) + '\n' for record in records),
+                                     content_type='application/x-ndjson')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'     # Do not let nginx buffer the stream
+    return response
+
+
+@csrf_exempt
+def asyncEE_stream(request):
+    '''Streaming version of asyncEE: each product is sent
+    as soon as its map IDs are ready'''
+    if request.method == 'POST':
+        return stream_response(request, landsat_product, 'landsat')
+
+
+def tile(request, mapid, z, x, y):
+    '''Serve an Earth Engine tile from the local tile cache,
+    fetching it from Earth Engine on a miss'''
+    if not tiles.MAPID.match(mapid):
+        raise Http404('Unknown map ID')
+
+    try:
+        data = tiles.get_tile(mapid, z, x, y)
+    except tiles.UpstreamError as e:
+        return HttpResponse(status=404 if e.status == 404 else 502)
+
+    etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+    if request.headers.get('If-None-Match') == etag:
+        response = HttpResponse(status=304)
+    else:
+        response = HttpResponse(data, content_type='image/png')
+    response['ETag'] = etag
+    response['Cache-Control'] = 'public, max-age={}'.format(settings.GEE_TILE_MAX_AGE)
+    return response
+
+
+
+
+
+
+
+
 #New App: Water Quality
 
 def water_quality_index(request):
@@ -79,17 +350,20 @@ def water_quality_index(request):
 def water_quality_map(request):
 
     if request.method == 'GET':     #Default first time loading of the page
-        f = open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'default_geojson.json'), encoding="utf-8")
-        data = json.load(f)
-        f.close()
-        return render(request, "water_quality/map.html", {'feature': json.dumps(data)})
+        # The page fetches the default AOI from default_aoi_geojson
+        return render(request, "water_quality/map.html", map_context(year=json.dumps(settings.GEE_DEFAULT_YEAR)))
 
     elif request.method == 'POST':      # Async data loading with custom params
         import urllib.parse
         data = json.loads( urllib.parse.unquote(request.body.decode('utf-8'))[5:])
         #data = json.loads(request.body.decode('utf-8'))
         
-        return render(request, "water_quality/map.html", {'feature': json.dumps(data['aoi']), 'year': json.dumps(data['year']) })
+        return render(request, "water_quality/map.html", map_context(feature=json.dumps(data['aoi']), year=json.dumps(data['year'])))
+
+
+def water_quality_product(layers, aoi, year):
+    '''Compute a water quality or a Landsat 8 product by its name'''
+    return compute_product(layers, 'water_quality', aoi, year)
 
 
 @csrf_exempt
@@ -102,40 +376,20 @@ def water_quality_asyncEE(request):
         aoi = data['aoi']
         year = data['year']
         layers = data['layers']
+        error = unknown_products(layers, 'water_quality')
+        if error:
+            return error
+
+        if isinstance(layers, list):
+            return JsonResponse(run_products(layers, water_quality_product, aoi, year))
 
-        # Check what layers were requested
-        if layers == 'ndci':
-            gee_data = copernicus_ndci(aoi, year)
-
-        if layers == 'composites':
-            gee_data = color_composites(aoi, year)
-        elif layers == 'min_cloud_ndvi':
-            gee_data = min_cloud_ndvi(aoi, year)
-        elif layers == 'max_ndvi':
-            gee_data = max_ndvi(aoi, year)
-        elif layers == 'max_evi':
-            gee_data = max_evi(aoi, year)
-        elif layers == 'max_ndwi':
-            gee_data = max_ndwi(aoi, year)
-        elif layers == 'doy_max_evi':
-            gee_data = doy_max_evi(aoi, year)
-        elif layers == 'doy_max_ndvi':
-            gee_data = doy_max_ndvi(aoi, year)
-        elif layers == 'doy_max_ndwi':
-            gee_data = doy_max_ndwi(aoi, year)
+        gee_data = water_quality_product(layers, aoi, year)
         
         return JsonResponse(gee_data)
 
 
-
-
-
-
-
-
-
-
-
-
-
-
+@csrf_exempt
+def water_quality_asyncEE_stream(request):
+    '''Streaming version of water_quality_asyncEE'''
+    if request.method == 'POST':
+        return stream_response(request, water_quality_product, 'water_quality')
@@ -0,0 +1,152 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import ee
+from django.conf import settings
+
+from . import ee_client
+from .aoi import prepare_aoi
+from .cache import gee_cache, params_hash
+from .products import INDICES
+from .service import start_gee_service
+
+
+logger = logging.getLogger(__name__)
+COMPOSITES = ['median', 'max']
+STATISTICS = ['mean', 'stdDev', 'min', 'max']
+
+# Chunks of parcels reduced concurrently, per process
+_executor = ThreadPoolExecutor(max_workers=settings.GEE_MAX_PARALLEL_PRODUCTS,
+                               thread_name_prefix='gee-zonal')
+
+
+def select_indices(indices=None):
+    '''The requested indices (default: all), in a fixed order'''
+    return [index for index in INDICES if index in (indices or INDICES)]
+
+
+def columns(indices=None):
+    '''Columns of the zonal statistics of some indices'''
+    indices = select_indices(indices)
+    return ['id', 'hash'] + ['{}_{}'.format(index, s) for index in indices for s in STATISTICS] + ['error']
+
+
+def bounds(features):
+    '''A Polygon Feature of the bounding box of all the parcels'''
+    xs, ys = [], []
+    for feature in features:
+        for polygon in prepare_aoi(feature).geometry['coordinates']:
+            for ring in polygon:
+                xs.extend(x for x, y in ring)
+                ys.extend(y for x, y in ring)
+
+    x0, y0, x1, y1 = min(xs), min(ys), max(xs), max(ys)
+    return {'type': 'Feature', 'properties': {}, 'geometry': {
+        'type': 'Polygon', 'coordinates': [[[x0, y0], [x1, y0], [x1, y1], [x0, y1], [x0, y0]]]}}
+
+
+def composite(aoi, year, name):
+    '''The yearly NDVI, EVI & NDWI composite the parcels are reduced over'''
+    from .call_gee import computeIndices, max_indices_image
+
+    if name == 'max':
+        return max_indices_image(aoi, year).select(['{}_max'.format(i) for i in INDICES], INDICES)
+    L8 = start_gee_service(aoi, year)['L8']
+    return ee.Image(L8.map(computeIndices).median())
+
+
+def chunks(parcels):
+    '''
+    Split the parcels into chunks small enough for one reduceRegions
+    call: at most GEE_ZONAL_CHUNK_FEATURES features, and at most
+    GEE_ZONAL_CHUNK_VERTICES vertices in the request payload
+    '''
+    chunk, vertices = [], 0
+    for parcel in parcels:
+        if chunk and (len(chunk) >= settings.GEE_ZONAL_CHUNK_FEATURES
+                      or vertices + parcel['vertices'] > settings.GEE_ZONAL_CHUNK_VERTICES):
+            yield chunk
+            chunk, vertices = [], 0
+        chunk.append(parcel)
+        vertices += parcel['vertices']
+    if chunk:
+        yield chunk
+
+
+def reduce_chunk(image, chunk, indices, scale):
+    '''Zonal statistics of a chunk of parcels, with a single getInfo'''
+    collection = ee.FeatureCollection([
+        ee.Feature(ee.Geometry.MultiPolygon(parcel['geometry']['coordinates']), {'hash': parcel['hash']})
+        for parcel in chunk
+    ])
+    reducer = (ee.Reducer.mean()
+               .combine(ee.Reducer.stdDev(), sharedInputs=True)
+               .combine(ee.Reducer.minMax(), sharedInputs=True))
+
+    stats = image.select(indices).reduceRegions(collection=collection, reducer=reducer, scale=scale)
+    # Only the properties are needed back, not the geometries
+    stats = ee_client.get_info(stats.select(['.*'], None, False), 'reduceRegions')
+
+    # Of a single band, the outputs are only named after the statistics
+    def output(index, s):
+        return s if len(indices) == 1 else '{}_{}'.format(index, s)
+
+    return {feature['properties']['hash']: {
+        '{}_{}'.format(index, s): feature['properties'].get(output(index, s))
+        for index in indices for s in STATISTICS
+    } for feature in stats['features']}
+
+
+def zonal_stats(collection, year, indices=None, composite_name='median', scale=30):
+    '''
+    Yield the zonal statistics (mean, stdDev, min & max of each
+    index) of every parcel of a GeoJSON FeatureCollection. Cached
+    parcels are yielded first; the others are reduced in chunks,
+    concurrently, and yielded chunk by chunk
+    '''
+    indices = select_indices(indices)
+    features = collection['features']
+    params = params_hash([indices, composite_name, scale])
+
+    parcels = []
+    for i, feature in enumerate(features):
+        prepared = prepare_aoi(feature)
+        parcels.append({
+            'id': feature.get('id', i),
+            'hash': prepared.hash,
+            'geometry': prepared.geometry,
+            'vertices': prepared.simplified_vertices,
+            'key': 'gee:zonal:{}:{}:{}'.format(prepared.hash, year, params),
+        })
+
+    cache = gee_cache()
+    cached = cache.get_many([parcel['key'] for parcel in parcels])
+    missing = []
+    for parcel in parcels:
+        if parcel['key'] in cached:
+            yield dict(id=parcel['id'], hash=parcel['hash'], **cached[parcel['key']])
+        else:
+            missing.append(parcel)
+    if not missing:
+        return
+
+    logger.info('Zonal statistics of %d parcels (%d cached)', len(parcels), len(parcels) - len(missing))
+    image = composite(bounds(features), year, composite_name)
+    futures = {
+        _executor.submit(reduce_chunk, image, chunk, indices, scale): chunk
+        for chunk in chunks(missing)
+    }
+    for future in as_completed(futures):
+        chunk = futures[future]
+        try:
+            stats = future.result()
+        except Exception as e:
+            logger.exception('Zonal statistics of %d parcels failed', len(chunk))
+            for parcel in chunk:
+                yield {'id': parcel['id'], 'hash': parcel['hash'], 'error': str(e)}
+            continue
+
+        cache.set_many({parcel['key']: stats[parcel['hash']] for parcel in chunk if parcel['hash'] in stats},
+                       settings.GEE_STATS_TTL)
+        for parcel in chunk:
+            yield dict(id=parcel['id'], hash=parcel['hash'], **stats.get(parcel['hash'], {}))
@@ -0,0 +1,36 @@
+"""Gunicorn *ASGI* config file"""
+import os
+import shutil
+
+# Django ASGI application path in pattern MODULE_NAME:VARIABLE_NAME
+wsgi_app = "djangoGEE.asgi:application"
+# Run the ASGI application on uvicorn workers
+worker_class = "uvicorn.workers.UvicornWorker"
+# Serve the EE endpoints with the native async views
+raw_env = ["GEE_ASYNC_VIEWS=1", "PROMETHEUS_MULTIPROC_DIR=/var/run/gunicorn/metrics"]
+# The granularity of Error log outputs
+loglevel = "info"
+# The number of worker processes for handling requests
+workers = 2
+# The socket to bind
+bind = "0.0.0.0:8083"
+# Write access and error info to /var/log
+accesslog = errorlog = "/var/log/gunicorn/asgi.log"
+# Redirect stdout/stderr to log file
+capture_output = True
+# PID file so you can easily fetch process ID
+pidfile = "/var/run/gunicorn/asgi.pid"
+# Daemonize the Gunicorn process (detach & enter background)
+daemon = True
+
+
+def on_starting(server):
+    """Start with an empty directory of Prometheus metrics"""
+    shutil.rmtree(server.cfg.env["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+    os.makedirs(server.cfg.env["PROMETHEUS_MULTIPROC_DIR"])
+
+
+def child_exit(server, worker):
+    """Drop the live gauges of an exited worker"""
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -1,7 +1,11 @@
 """Gunicorn *development* config file"""
+import os
+import shutil
 
 # Django WSGI application path in pattern MODULE_NAME:VARIABLE_NAME
 wsgi_app = "djangoGEE.wsgi:application"
+# Aggregate the Prometheus metrics of all the workers
+raw_env = ["PROMETHEUS_MULTIPROC_DIR=/var/run/gunicorn/metrics"]
 # The granularity of Error log outputs
 loglevel = "debug"
 # The number of worker processes for handling requests
@@ -18,3 +22,15 @@ capture_output = True
 pidfile = "/var/run/gunicorn/dev.pid"
 # Daemonize the Gunicorn process (detach & enter background)
 daemon = True
+
+
+def on_starting(server):
+    """Start with an empty directory of Prometheus metrics"""
+    shutil.rmtree(server.cfg.env["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+    os.makedirs(server.cfg.env["PROMETHEUS_MULTIPROC_DIR"])
+
+
+def child_exit(server, worker):
+    """Drop the live gauges of an exited worker"""
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)